@@ -1,11 +1,22 @@
 #!/usr/bin/python3
 # pylint: disable=missing-docstring,invalid-name
 import sqlite3
+import base64
+import collections
 import hashlib
+import heapq
+import itertools
+import math
 import os
 import re
 import json
+import csv
+import io
+import queue
+import threading
+import time
 import datetime
+import click
 from flask import (
     Flask,
     render_template,
@@ -16,8 +27,12 @@ from flask import (
     send_from_directory,
     redirect,
     session,
-    flash
+    flash,
+    Response,
+    stream_with_context,
+    jsonify
 )
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 
 class Markup(object):
@@ -33,6 +48,12 @@ class Markup(object):
         html = html.replace("\n", "<br />")
         return html, text
 
+    @staticmethod
+    def hashtags(text):
+        # the tags prettify_text links to, lowercase
+        text = re.sub('<[^<]+?>', '', text)
+        return set(tag.lower() for tag in re.findall(r"#(\w+)", text))
+
     def clean_html(self, text):
         # allow "downgrading" html to text on next edit
         # by stripping html tags
@@ -48,15 +69,46 @@ class DBSchemaHandler(object):
         self.prefix = prefix
 
         if self.database_v() == '-1':
-            self.create_v1c()
+            self.step(self.create_v1h)
         if self.database_v() == '0':
-            self.migrate_v0to1()
+            self.step(self.migrate_v0to1)
         if self.database_v() == '1':
-            self.migrate_v1to1a()
+            self.step(self.migrate_v1to1a)
         if self.database_v() == '1a':
-            self.migrate_v1ato1b()
+            self.step(self.migrate_v1ato1b)
         if self.database_v() == '1b':
-            self.migrate_v1bto1c()
+            self.step(self.migrate_v1bto1c)
+        if self.database_v() == '1c':
+            self.step(self.migrate_v1cto1d)
+        if self.database_v() == '1d':
+            self.step(self.migrate_v1dto1e)
+        if self.database_v() == '1e':
+            self.step(self.migrate_v1eto1f)
+        if self.database_v() == '1f':
+            # straight to v1h, migrate_v1gto1h cannot bring back the
+            # pre-v0 votes the v1g dedupe merged
+            self.step(self.migrate_v1fto1h)
+        if self.database_v() == '1g':
+            self.step(self.migrate_v1gto1h)
+
+        self.step(self.ensure_tallies)
+        self.step(self.ensure_search)
+        self.step(self.ensure_tags)
+
+    def step(self, migration):
+        # every step runs in one transaction, so an interrupted run
+        # leaves the previous version behind and the next start resumes
+        # from there
+        start = time.monotonic()
+        self.c.execute("BEGIN IMMEDIATE")
+        try:
+            migration()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        app.logger.info("%s took %.1fs", migration.__name__,
+                        time.monotonic() - start)
 
     def database_v(self):
         versions = {
@@ -64,7 +116,12 @@ class DBSchemaHandler(object):
             'v1_jokes': '1',
             'v1a_jokes': '1a',
             'v1b_jokes': '1b',
-            'v1c_jokes': '1c'
+            'v1c_jokes': '1c',
+            'v1d_jokes': '1d',
+            'v1e_jokes': '1e',
+            'v1f_jokes': '1f',
+            'v1g_jokes': '1g',
+            'v1h_jokes': '1h'
         }
         for ver in versions:
             if self.c.execute("SELECT COUNT(*) FROM sqlite_master " +
@@ -82,7 +139,6 @@ class DBSchemaHandler(object):
         self.c.execute("CREATE TABLE votes(" +
                        "id INTEGER PRIMARY KEY NOT NULL, " +
                        "ip TEXT, jokeid INTEGER, type INTEGER)")
-        self.conn.commit()
 
     def create_v1(self):
         app.logger.warning("creating new v1 database")
@@ -95,7 +151,6 @@ class DBSchemaHandler(object):
         self.c.execute("CREATE TABLE v1_votes(" +
                        "id INTEGER PRIMARY KEY NOT NULL, " +
                        "joke INTEGER, user INTEGER, type TEXT)")
-        self.conn.commit()
 
     def create_v1a(self):
         app.logger.warning("creating new " + self.prefix + " database")
@@ -109,7 +164,6 @@ class DBSchemaHandler(object):
                        "id INTEGER PRIMARY KEY NOT NULL, " +
                        "identifier TEXT, role TEXT DEFAULT 'guest', " +
                        "password TEXT DEFAULT '', salt TEXT DEFAULT '')")
-        self.conn.commit()
 
     def create_v1b(self):
         self.create_v1a()
@@ -127,9 +181,151 @@ class DBSchemaHandler(object):
                        "id INTEGER PRIMARY KEY NOT NULL, " +
                        "identifier TEXT, role TEXT DEFAULT 'guest', " +
                        "password TEXT DEFAULT '', salt TEXT DEFAULT '')")
-        self.conn.commit()
 
-    def migrate_v0to1(self):  # pylint: disable=too-many-locals
+    def create_v1d(self):
+        self.create_v1c()
+        self.create_v1d_indexes(self.prefix)
+
+    def create_v1d_indexes(self, prefix):
+        self.c.execute("CREATE INDEX " + prefix + "_votes_joke_user " +
+                       "ON " + prefix + "_votes(joke, user, type)")
+        self.c.execute("CREATE INDEX " + prefix + "_votes_type_joke " +
+                       "ON " + prefix + "_votes(type, joke)")
+        self.c.execute("CREATE INDEX " + prefix + "_votes_user " +
+                       "ON " + prefix + "_votes(user, type, joke)")
+        self.c.execute("CREATE INDEX " + prefix + "_users_identifier " +
+                       "ON " + prefix + "_users(identifier, role)")
+
+    def create_v1e(self):
+        self.create_v1d()
+        self.create_v1e_tables(self.prefix)
+
+    def create_v1e_tables(self, prefix):
+        self.c.execute("CREATE INDEX " + prefix + "_jokes_created " +
+                       "ON " + prefix + "_jokes(created)")
+        self.c.execute("CREATE TABLE " + prefix + "_meta(" +
+                       "key TEXT PRIMARY KEY NOT NULL, value TEXT)")
+
+    def create_v1f(self):
+        self.create_v1e()
+        self.c.execute("ALTER TABLE " + self.prefix + "_jokes " +
+                       "ADD COLUMN html TEXT")
+
+    def create_v1g(self):
+        self.create_v1f()
+        self.create_v1g_indexes(self.prefix)
+
+    def create_v1g_indexes(self, prefix):
+        # one vote and one deletion mark per joke and user
+        self.c.execute("CREATE UNIQUE INDEX " + prefix + "_votes_vote " +
+                       "ON " + prefix + "_votes(joke, user) " +
+                       "WHERE type IN ('up', 'down')")
+        self.c.execute("CREATE UNIQUE INDEX " + prefix + "_votes_delete " +
+                       "ON " + prefix + "_votes(joke, user) " +
+                       "WHERE type='delete'")
+
+    def create_v1h(self):
+        self.create_v1g()
+        self.create_v1h_users(self.prefix, self.prefix + "_users")
+        self.create_v1h_legacy(self.prefix)
+
+    def create_v1h_users(self, prefix, source):
+        # guest ids are never reused, a vote for a guest that gc_guests
+        # deleted meanwhile does not end up with the next visitor
+        self.c.execute("CREATE TABLE " + prefix + "_users_new(" +
+                       "id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, " +
+                       "identifier TEXT, role TEXT DEFAULT 'guest', " +
+                       "password TEXT DEFAULT '', salt TEXT DEFAULT '')")
+        self.c.execute("INSERT INTO " + prefix + "_users_new" +
+                       "(id, identifier, role, password, salt) " +
+                       "SELECT id, identifier, role, password, salt " +
+                       "FROM " + source)
+        self.c.execute("DROP TABLE " + source)
+        self.c.execute("ALTER TABLE " + prefix + "_users_new " +
+                       "RENAME TO " + prefix + "_users")
+        self.c.execute("CREATE INDEX " + prefix + "_users_identifier " +
+                       "ON " + prefix + "_users(identifier, role)")
+
+    def create_v1h_legacy(self, prefix):
+        # pre-v0 votes are only known as counts per joke,
+        # they count like guest votes, see DBProxy.tally_select
+        self.c.execute("ALTER TABLE " + prefix + "_jokes ADD COLUMN " +
+                       "legacy_up INTEGER NOT NULL DEFAULT 0")
+        self.c.execute("ALTER TABLE " + prefix + "_jokes ADD COLUMN " +
+                       "legacy_down INTEGER NOT NULL DEFAULT 0")
+
+    def has_table(self, name):
+        return self.c.execute("SELECT COUNT(*) FROM sqlite_master " +
+                              "WHERE type='table' AND name=?",
+                              (name,)).fetchone()['COUNT(*)'] == 1
+
+    def ensure_tallies(self):
+        # derived table, (re)built from the votes if it is missing or outdated
+        columns = ['joke', 'guest_up', 'guest_down', 'member_up',
+                   'member_down', 'deleted', 'score', 'rank']
+        tallies = self.prefix + "_tallies"
+        if self.has_table(tallies):
+            if [col['name'] for col in self.c.execute(
+                    "PRAGMA table_info(" + tallies + ")")] == columns:
+                # votes for missing jokes used to create tallies
+                self.c.execute("DELETE FROM " + tallies + " WHERE joke " +
+                               "NOT IN (SELECT id FROM " + self.prefix +
+                               "_jokes)")
+                if self.c.rowcount:
+                    app.logger.warning("deleted %d tallies of missing jokes",
+                                       self.c.rowcount)
+                    self.c.execute("UPDATE " + self.prefix + "_meta " +
+                                   "SET value=value+1 WHERE key='version'")
+                return
+            self.c.execute("DROP TABLE " + tallies)
+        app.logger.warning("building vote tallies")
+        # member_* are weighted, see DBProxy.tally_select
+        self.c.execute("CREATE TABLE " + tallies + "(" +
+                       "joke INTEGER PRIMARY KEY NOT NULL, " +
+                       "guest_up INTEGER DEFAULT 0, " +
+                       "guest_down INTEGER DEFAULT 0, " +
+                       "member_up INTEGER DEFAULT 0, " +
+                       "member_down INTEGER DEFAULT 0, " +
+                       "deleted INTEGER DEFAULT 0, " +
+                       "score INTEGER DEFAULT 0, " +
+                       "rank REAL DEFAULT 1)")
+        self.c.execute("CREATE INDEX " + tallies + "_score " +
+                       "ON " + tallies + "(deleted, score DESC)")
+        self.c.execute("CREATE INDEX " + tallies + "_rank " +
+                       "ON " + tallies + "(deleted, rank DESC)")
+        self.c.execute("INSERT INTO " + tallies + " " +
+                       DBProxy.tally_select(self.prefix))
+
+    def ensure_search(self):
+        # derived full text index of the jokes, built if it is missing
+        search = self.prefix + "_search"
+        if self.has_table(search):
+            return
+        app.logger.warning("building search index")
+        self.c.execute("CREATE VIRTUAL TABLE " + search + " USING fts5(text)")
+        self.c.execute("INSERT INTO " + search + "(rowid, text) " +
+                       "SELECT id, text FROM " + self.prefix + "_jokes")
+
+    def ensure_tags(self):
+        # derived index of the hashtags in the jokes, built if it is missing
+        tags = self.prefix + "_tags"
+        if self.has_table(tags):
+            return
+        app.logger.warning("building tag index")
+        self.c.execute("CREATE TABLE " + tags + "(" +
+                       "tag TEXT NOT NULL, joke INTEGER NOT NULL, " +
+                       "PRIMARY KEY(tag, joke)) WITHOUT ROWID")
+        self.c.execute("CREATE INDEX " + tags + "_joke " +
+                       "ON " + tags + "(joke)")
+        jokes = self.conn.cursor()
+        jokes.execute("SELECT id, text FROM " + self.prefix + "_jokes " +
+                      "WHERE text LIKE '%#%'")
+        self.c.executemany("INSERT INTO " + tags + "(tag, joke) " +
+                           "VALUES(?, ?)",
+                           ((tag, joke['id']) for joke in jokes
+                            for tag in Markup.hashtags(joke['text'])))
+
+    def migrate_v0to1(self):
         app.logger.warning("migrating database from v0 to v1")
         self.create_v1()
 
@@ -137,63 +333,47 @@ class DBSchemaHandler(object):
         anonymous = self.c.lastrowid
 
         # create new jokes
-        j = self.c.execute("SELECT * FROM jokes").fetchall()
-        j = [(int(n['id']), n['text'], anonymous) for n in j]
-        self.c.executemany("INSERT INTO v1_jokes(id, text, format, user) " +
-                           "VALUES(?, ?, 'html', ?)", j)
-
-        votes = self.c.execute("SELECT * FROM votes").fetchall()
+        self.c.execute("INSERT INTO v1_jokes(id, text, format, user) " +
+                       "SELECT id, text, 'html', ? FROM jokes", (anonymous,))
+        app.logger.warning("migrated %d jokes", self.c.rowcount)
 
         # create new users
-        ips = set([v['ip'] for v in votes])  # uniquify
-        ips = [(ip,) for ip in ips]
-        self.c.executemany("INSERT INTO v1_users(identifier) VALUES(?)", ips)
+        self.c.execute("INSERT INTO v1_users(identifier) " +
+                       "SELECT DISTINCT ip FROM votes")
+        app.logger.warning("migrated %d users", self.c.rowcount)
 
         # create votes
-        for vote in votes:
-            user = int(self.c.execute("SELECT id FROM v1_users " +
-                                      "WHERE identifier=?",
-                                      (vote['ip'],)).fetchone()['id'])
-            if vote['type'] == -1:
-                vtype = 'down'
-            if vote['type'] == 0:
-                vtype = 'report'
-            if vote['type'] == 1:
-                vtype = 'up'
-            self.c.execute("INSERT INTO v1_votes(joke, user, type) " +
-                           "VALUES(?, ?, ?)", (vote['jokeid'], user, vtype))
-
-        # create pre-v0 votes
-        jokes = self.c.execute("SELECT id FROM v1_jokes").fetchall()
-        jokes = [int(j['id']) for j in jokes]
-        for joke in jokes:
-            types = (
-                ("up", "upvotes"),
-                ("down", "downvotes"),
-                ("report", "reports")
-            )
-            for newtype, oldtype in types:
-                legal_votes = int(self.c.execute("SELECT COUNT(*) FROM " +
-                                                 "v1_votes WHERE id=? " +
-                                                 "AND type=?", (joke, newtype))
-                                  .fetchone()['COUNT(*)'])
-                real_votes = int(self.c.execute("SELECT * FROM jokes " +
-                                                "WHERE id=?",
-                                                (joke,)).fetchone()[oldtype])
-                diff = real_votes - legal_votes
-                if diff:
-                    self.c.executemany("INSERT INTO " +
-                                       "v1_votes(joke, user, type) " +
-                                       "VALUES(?, ?, ?)",
-                                       [(joke, anonymous, newtype)]*diff)
+        self.c.execute("INSERT INTO v1_votes(joke, user, type) " +
+                       "SELECT v.jokeid, u.id, CASE v.type " +
+                       "WHEN -1 THEN 'down' WHEN 0 THEN 'report' " +
+                       "WHEN 1 THEN 'up' END " +
+                       "FROM votes AS v " +
+                       "JOIN v1_users AS u ON u.identifier=v.ip " +
+                       "ORDER BY v.id")
+        app.logger.warning("migrated %d votes", self.c.rowcount)
+
+        # create pre-v0 votes, the counters minus the migrated votes
+        self.c.execute("INSERT INTO v1_votes(joke, user, type) " +
+                       "WITH RECURSIVE missing(joke, type, n) AS (" +
+                       "SELECT c.joke, c.type, c.n - IFNULL(v.n, 0) " +
+                       "FROM (" +
+                       "SELECT id AS joke, 'up' AS type, upvotes AS n " +
+                       "FROM jokes UNION ALL " +
+                       "SELECT id, 'down', downvotes FROM jokes UNION ALL " +
+                       "SELECT id, 'report', reports FROM jokes) AS c " +
+                       "LEFT JOIN (SELECT joke, type, COUNT(*) AS n " +
+                       "FROM v1_votes GROUP BY joke, type) AS v " +
+                       "ON v.joke=c.joke AND v.type=c.type " +
+                       "UNION ALL " +
+                       "SELECT joke, type, n-1 FROM missing WHERE n > 1) " +
+                       "SELECT joke, ?, type FROM missing WHERE n > 0",
+                       (anonymous,))
+        app.logger.warning("migrated %d pre-v0 votes", self.c.rowcount)
 
         # drop old tables
         self.c.execute("DROP TABLE jokes")
         self.c.execute("DROP TABLE IF EXISTS votes")
 
-        # write
-        self.conn.commit()
-
     def migrate_v1to1a(self):
         app.logger.warning("migrating database from v1 to v1a")
         self.c.execute("ALTER TABLE v1_jokes RENAME TO v1a_jokes")
@@ -206,7 +386,6 @@ class DBSchemaHandler(object):
         self.c.execute("INSERT INTO v1a_users(id, identifier) SELECT id, " +
                        "identifier FROM v1_users")
         self.c.execute("DROP TABLE v1_users")
-        self.conn.commit()
 
     def migrate_v1ato1b(self):
         app.logger.warning("migrating database from v1a to v1b")
@@ -216,7 +395,6 @@ class DBSchemaHandler(object):
         self.c.execute("UPDATE v1b_jokes SET format='prettytext' " +
                        "WHERE format='markdown'")
         self.c.execute("UPDATE v1b_votes SET type='down' WHERE type='report'")
-        self.conn.commit()
 
     def migrate_v1bto1c(self):
         app.logger.warning("migrating database from v1b to v1c")
@@ -230,101 +408,659 @@ class DBSchemaHandler(object):
         self.c.execute("ALTER TABLE v1b_votes RENAME TO v1c_votes")
         self.c.execute("ALTER TABLE v1b_users RENAME TO v1c_users")
         # lowercase all usernames, throw away the most recent duplicate
-        users = self.c.execute("SELECT id, identifier FROM v1c_users " +
-                               "ORDER BY id").fetchall()
-        dupes = []
-        for cnt, user in enumerate(users):
-            for ocnt, other in enumerate(users[cnt+1:]):
-                if user["identifier"].lower() == other["identifier"].lower():
-                    app.logger.warning("deleting duplicate user " +
-                                       other["identifier"])
-                    dupes.append((other["id"],))
-                    del users[cnt+ocnt]
-
-        self.c.executemany("UPDATE v1c_users SET " +
-                           "role='guest', " +
-                           "identifier=identifier||CAST(id AS TEXT), " +
-                           "password='', salt='' WHERE id=?",
-                           dupes)
+        self.c.execute("UPDATE v1c_users SET " +
+                       "role='guest', " +
+                       "identifier=identifier||CAST(id AS TEXT), " +
+                       "password='', salt='' WHERE id NOT IN (" +
+                       "SELECT MIN(id) FROM v1c_users " +
+                       "GROUP BY LOWER(identifier))")
+        app.logger.warning("renamed %d duplicate users", self.c.rowcount)
         self.c.execute("UPDATE v1c_users SET " +
                        "identifier=LOWER(identifier)")
 
-        # add a (fake) date
-        jokes = self.c.execute("SELECT id, text, format, user " +
-                               "FROM v1b_jokes").fetchall()
-        newest_id = max([j['id'] for j in jokes])
-        now = datetime.datetime.now()
-        for joke in jokes:
-            self.c.execute("INSERT INTO " +
-                           "v1c_jokes(id, text, format, user, created) " +
-                           "VALUES(?, ?, ?, ?, ?)",
-                           (joke['id'],
-                            joke['text'],
-                            joke['format'],
-                            joke['user'],
-                            now-datetime.timedelta(
-                                days=(newest_id-joke['id']))))
+        # add a (fake) date, one day per joke before the newest
+        self.c.execute("INSERT INTO " +
+                       "v1c_jokes(id, text, format, user, created) " +
+                       "SELECT id, text, format, user, " +
+                       "datetime(?, (id - (SELECT MAX(id) FROM v1b_jokes))" +
+                       " || ' days') FROM v1b_jokes",
+                       (datetime.datetime.now().isoformat(' '),))
+        app.logger.warning("migrated %d jokes", self.c.rowcount)
         self.c.execute("DROP TABLE v1b_jokes")
-        self.conn.commit()
 
 
-class DBProxy(object):
-    def __init__(self, database, rootName):
-        def dict_factory(cursor, row):
-            dic = {}
-            for idx, col in enumerate(cursor.description):
-                dic[col[0]] = row[idx]
-            return dic
+    def migrate_v1cto1d(self):
+        app.logger.warning("migrating database from v1c to v1d")
+        self.c.execute("ALTER TABLE v1c_jokes RENAME TO v1d_jokes")
+        self.c.execute("ALTER TABLE v1c_votes RENAME TO v1d_votes")
+        self.c.execute("ALTER TABLE v1c_users RENAME TO v1d_users")
+        # derived, rebuilt by ensure_tallies
+        self.c.execute("DROP TABLE IF EXISTS v1c_tallies")
+        self.create_v1d_indexes("v1d")
+
+    def migrate_v1dto1e(self):
+        app.logger.warning("migrating database from v1d to v1e")
+        self.c.execute("ALTER TABLE v1d_jokes RENAME TO v1e_jokes")
+        self.c.execute("ALTER TABLE v1d_votes RENAME TO v1e_votes")
+        self.c.execute("ALTER TABLE v1d_users RENAME TO v1e_users")
+        # derived, rebuilt by ensure_tallies
+        self.c.execute("DROP TABLE IF EXISTS v1d_tallies")
+        self.create_v1e_tables("v1e")
+
+    def migrate_v1eto1f(self):
+        app.logger.warning("migrating database from v1e to v1f")
+        self.c.execute("ALTER TABLE v1e_jokes RENAME TO v1f_jokes")
+        self.c.execute("ALTER TABLE v1e_votes RENAME TO v1f_votes")
+        self.c.execute("ALTER TABLE v1e_users RENAME TO v1f_users")
+        self.c.execute("ALTER TABLE v1e_meta RENAME TO v1f_meta")
+        # derived, rebuilt by ensure_tallies and ensure_search
+        self.c.execute("DROP TABLE IF EXISTS v1e_tallies")
+        self.c.execute("DROP TABLE IF EXISTS v1e_search")
+        # render the jokes once, html jokes keep their markup in html
+        # and the stripped text for the next edit
+        self.c.execute("ALTER TABLE v1f_jokes ADD COLUMN html TEXT")
+        jokes = self.c.execute("SELECT id, text, format " +
+                               "FROM v1f_jokes").fetchall()
+        self.c.executemany("UPDATE v1f_jokes SET html=?, text=? WHERE id=?",
+                           [DBProxy.render(joke['text'], joke['format']) +
+                            (joke['id'],) for joke in jokes])
+
+    def migrate_v1fto1h(self):
+        app.logger.warning("migrating database from v1f to v1h")
+        self.c.execute("ALTER TABLE v1f_jokes RENAME TO v1h_jokes")
+        self.c.execute("ALTER TABLE v1f_votes RENAME TO v1h_votes")
+        self.c.execute("ALTER TABLE v1f_meta RENAME TO v1h_meta")
+        if self.has_table("v1f_search"):
+            self.c.execute("ALTER TABLE v1f_search RENAME TO v1h_search")
+        self.create_v1h_users("v1h", "v1f_users")
+        # derived, rebuilt by ensure_tallies
+        self.c.execute("DROP TABLE IF EXISTS v1f_tallies")
+        # migrate_v0to1 stored the pre-v0 counters as many votes of one
+        # guest, the dedupe below would leave one of them
+        self.create_v1h_legacy("v1h")
+        legacy = self.c.execute("SELECT id FROM v1h_users " +
+                                "WHERE role='guest' AND " +
+                                "identifier='anonymous'").fetchone()
+        if legacy is not None:
+            self.c.execute("UPDATE v1h_jokes SET " +
+                           "legacy_up=(SELECT COUNT(*) FROM v1h_votes " +
+                           "WHERE joke=v1h_jokes.id AND user=? AND " +
+                           "type='up'), " +
+                           "legacy_down=(SELECT COUNT(*) FROM v1h_votes " +
+                           "WHERE joke=v1h_jokes.id AND user=? AND " +
+                           "type='down')", (legacy['id'], legacy['id']))
+            self.c.execute("DELETE FROM v1h_votes WHERE user=? AND " +
+                           "type IN ('up', 'down')", (legacy['id'],))
+            app.logger.warning("moved %d pre-v0 votes into counters",
+                               self.c.rowcount)
+        # keep the latest vote and the first deletion mark
+        # per joke and user
+        self.c.execute("DELETE FROM v1h_votes WHERE type IN ('up', 'down') " +
+                       "AND id NOT IN (SELECT MAX(id) FROM v1h_votes " +
+                       "WHERE type IN ('up', 'down') GROUP BY joke, user)")
+        app.logger.warning("deleted %d duplicate votes", self.c.rowcount)
+        self.c.execute("DELETE FROM v1h_votes WHERE type='delete' " +
+                       "AND id NOT IN (SELECT MIN(id) FROM v1h_votes " +
+                       "WHERE type='delete' GROUP BY joke, user)")
+        app.logger.warning("deleted %d duplicate deletion marks",
+                           self.c.rowcount)
+        self.create_v1g_indexes("v1h")
+
+    def migrate_v1gto1h(self):
+        # the pre-v0 votes that the v1g dedupe merged stay merged
+        app.logger.warning("migrating database from v1g to v1h")
+        self.c.execute("ALTER TABLE v1g_jokes RENAME TO v1h_jokes")
+        self.c.execute("ALTER TABLE v1g_votes RENAME TO v1h_votes")
+        self.c.execute("ALTER TABLE v1g_meta RENAME TO v1h_meta")
+        if self.has_table("v1g_search"):
+            self.c.execute("ALTER TABLE v1g_search RENAME TO v1h_search")
+        if self.has_table("v1g_tags"):
+            self.c.execute("ALTER TABLE v1g_tags RENAME TO v1h_tags")
+        self.create_v1h_users("v1h", "v1g_users")
+        # derived, rebuilt by ensure_tallies
+        self.c.execute("DROP TABLE IF EXISTS v1g_tallies")
+        # some v1g databases already kept the counters
+        if 'legacy_up' not in [col['name'] for col in self.c.execute(
+                "PRAGMA table_info(v1h_jokes)")]:
+            self.create_v1h_legacy("v1h")
+
+
+class TimedConnection(sqlite3.Connection):
+    # counts the statements, commits and the time spent in the database
+    # since the last reset, see TimedCursor
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # seconds after which a statement is logged, None to disable
+        self.slow_query = None
+        self.reset()
+
+    def reset(self):
+        self.statements = 0
+        self.commits = 0
+        self.db_time = 0.0
+        self.slowest = (0.0, None)
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TimedCursor)
+
+    def commit(self):
+        start = time.perf_counter()
+        super().commit()
+        self.commits += 1
+        self.db_time += time.perf_counter() - start
+
+    def record(self, sql, elapsed):
+        self.statements += 1
+        self.db_time += elapsed
+        if elapsed > self.slowest[0]:
+            self.slowest = (elapsed, sql)
+        if self.slow_query is not None and elapsed >= self.slow_query:
+            app.logger.warning("slow query (%.1fms): %s",
+                               elapsed * 1000, sql)
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.record(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.record(sql, time.perf_counter() - start)
+
+    # rows after the first are stepped while fetching
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self.connection.db_time += time.perf_counter() - start
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(size or self.arraysize)
+        finally:
+            self.connection.db_time += time.perf_counter() - start
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self.connection.db_time += time.perf_counter() - start
+
+
+class JokeView(object):
+    # a joke of get_jokes as the viewer sees it, reads the rest of the row
+    # only for the jokes that are shown
+    __slots__ = ('row', 'upvoted', 'downvoted', 'score', 'mine',
+                 'freshness', 'deleted')
+
+    def __init__(self, row, votes, weight, user, iamroot, now):
+        # votes: the viewer's votes on the joke, comma separated
+        # weight: weight of the viewer's votes
+        self.row = row
+        self.upvoted, self.downvoted, self.score = DBProxy.viewer_votes(
+            row['score'], votes, weight)
+        # allow deletion
+        self.mine = (user is not None and row['user'] == user) or iamroot
+        self.freshness = (now - row['created']).days
+        self.deleted = bool(row['deleted'])
+        if self.deleted:
+            self.score = -100
+
+    @property
+    def id(self):
+        return self.row['id']
+
+    @property
+    def html(self):
+        return self.row['html']
+
+    @property
+    def text(self):
+        return self.row['text']
+
 
+class DBProxy(object):
+    def __init__(self, database, rank_refresh=3600, journal_mode='wal',
+                 synchronous='normal', busy_timeout=5, cache=None,
+                 slow_query=None, uri=False, root_name=None):
+        # connections are handed between threads by DBPool,
+        # but only used by one thread at a time
         self.conn = sqlite3.connect(database,
-                                    detect_types=sqlite3.PARSE_DECLTYPES)
-        self.conn.row_factory = dict_factory
+                                    detect_types=sqlite3.PARSE_DECLTYPES,
+                                    check_same_thread=False,
+                                    cached_statements=256,
+                                    timeout=busy_timeout,
+                                    factory=TimedConnection,
+                                    uri=uri)
+        self.conn.slow_query = slow_query
+        # tuples with access by column name, no dict per row
+        self.conn.row_factory = sqlite3.Row
+        self.conn.create_function("joke_rank", 2, self.created_rank)
         self.c = self.conn.cursor()
-
-        self.prefix = "v1c"
+        if synchronous.lower() not in ('off', 'normal', 'full', 'extra'):
+            raise ValueError("invalid synchronous level " + synchronous)
+        self.c.execute("PRAGMA synchronous=" + synchronous)
+
+        # seconds after which the ranks are decayed,
+        # None if another connection decays them
+        self.rank_refresh = rank_refresh
+        self.journal_mode = journal_mode
+        # JokeCache shared by the connections of this process
+        self.cache = cache
+        # the configured superuser, promoted on startup and on registration
+        self.root_name = root_name
+        self.prefix = "v1h"
+
+    def setup(self):
+        # once per process, before the connection is used
+        if self.journal_mode.lower() not in ('delete', 'truncate', 'persist',
+                                             'memory', 'wal'):
+            raise ValueError("invalid journal mode " + self.journal_mode)
+        # persistent, readers do not block writers in wal mode
+        self.c.execute("PRAGMA journal_mode=" + self.journal_mode)
         DBSchemaHandler(self.conn, self.c, self.prefix)
-
-        self.root_user(rootName)
+        self.c.execute("INSERT OR IGNORE INTO " + self.prefix + "_meta" +
+                       "(key, value) VALUES('version', 0), ('users', 0), " +
+                       "('modified', ?)", (self.now(),))
+        self.conn.commit()
+        self.root_user(self.root_name)
+
+    def data_version(self):
+        # changes with every write to jokes, votes, roles or ranks
+        return self.c.execute("SELECT value FROM " + self.prefix +
+                              "_meta WHERE key='version'").fetchone()['value']
+
+    def data_state(self):
+        # data version and the time of the last write
+        state = dict((row['key'], row['value']) for row in self.c.execute(
+            "SELECT key, value FROM " + self.prefix + "_meta " +
+            "WHERE key IN ('version', 'modified')"))
+        return (state['version'],
+                datetime.datetime.fromisoformat(state['modified']))
+
+    @staticmethod
+    def now():
+        return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    def users_version(self):
+        # changes whenever a user's role changes or guests are deleted
+        return self.c.execute("SELECT value FROM " + self.prefix +
+                              "_meta WHERE key='users'").fetchone()['value']
+
+    def _changed(self):
+        self.c.execute("UPDATE " + self.prefix + "_meta " +
+                       "SET value=CASE key WHEN 'version' THEN value+1 " +
+                       "ELSE ? END WHERE key IN ('version', 'modified')",
+                       (self.now(),))
 
     def close(self):
         self.conn.close()
 
-    def score(self, jokeid, exclude_voter=None):
+    @staticmethod
+    def rank(score, freshness):
+        return (score+1)/pow(freshness+1, 1.8)
+
+    @staticmethod
+    def created_rank(score, created):
+        # SQL function joke_rank(score, created)
+        freshness = 0
+        if created:
+            freshness = (datetime.datetime.now() -
+                         datetime.datetime.fromisoformat(created)).days
+        return DBProxy.rank(score, freshness)
+
+    @staticmethod
+    def tally_select(prefix):
+        # recount the tallies from the votes
+        # guest votes count once, user's votes count 3 times,
+        # the pre-v0 counters are guest votes
+        member = "IFNULL(u.role, '') IN ('user', 'super')"
+        score = "guest_up-guest_down+member_up-member_down"
+        return ("SELECT joke, guest_up, guest_down, member_up, " +
+                "member_down, deleted, " + score + " AS score, " +
+                "joke_rank(" + score + ", created) AS rank FROM (" +
+                "SELECT j.id AS joke, j.created, " +
+                "COUNT(CASE WHEN v.type='up' AND NOT " + member +
+                " THEN 1 END)+j.legacy_up AS guest_up, " +
+                "COUNT(CASE WHEN v.type='down' AND NOT " + member +
+                " THEN 1 END)+j.legacy_down AS guest_down, " +
+                "COUNT(CASE WHEN v.type='up' AND " + member +
+                " THEN 1 END)*3 AS member_up, " +
+                "COUNT(CASE WHEN v.type='down' AND " + member +
+                " THEN 1 END)*3 AS member_down, " +
+                "COUNT(CASE WHEN v.type='delete' THEN 1 END) AS deleted " +
+                "FROM " + prefix + "_jokes j " +
+                "LEFT JOIN " + prefix + "_votes v ON v.joke=j.id " +
+                "LEFT JOIN " + prefix + "_users u ON u.id=v.user " +
+                "GROUP BY j.id)")
+
+    def rebuild_tallies(self):
+        self.c.execute("DELETE FROM " + self.prefix + "_tallies")
+        self.c.execute("INSERT INTO " + self.prefix + "_tallies " +
+                       self.tally_select(self.prefix))
+        self._changed()
+        self.conn.commit()
+
+    def verify_tallies(self):
+        # return the ids of jokes whose tallies drifted from the votes
+        cols = ('guest_up', 'guest_down', 'member_up', 'member_down',
+                'deleted', 'score')
+        stored = self.c.execute("SELECT * FROM " + self.prefix +
+                                "_tallies").fetchall()
+        stored = {t['joke']: t for t in stored}
+        drifted = []
+        for real in self.c.execute(
+                self.tally_select(self.prefix)).fetchall():
+            tally = stored.get(real['joke'])
+            if tally is None or \
+                    any(tally[col] != real[col] for col in cols):
+                drifted.append(real['joke'])
+        return drifted
+
+    def _tally(self, joke, vtype, user, sign=1):
+        # add (or remove) a single vote to the joke's tally
+        self._changed()
+        if vtype == 'delete':
+            col, weight = 'deleted', 1
+        else:
+            role = self.c.execute("SELECT role FROM " + self.prefix +
+                                  "_users WHERE id=?", (user,)).fetchone()
+            if role and role['role'] in ('user', 'super'):
+                col, weight = 'member_' + vtype, 3
+            else:
+                col, weight = 'guest_' + vtype, 1
+        # jokes get their tally when they are added
+        self.c.execute("UPDATE " + self.prefix + "_tallies SET " +
+                       col + "=" + col + "+? WHERE joke=?",
+                       (sign * weight, joke))
+        if col != 'deleted':
+            delta = sign * weight * (1 if vtype == 'up' else -1)
+            self.c.execute(
+                "UPDATE " + self.prefix + "_tallies SET " +
+                "score=score+?, rank=joke_rank(score+?, (SELECT created " +
+                "FROM " + self.prefix + "_jokes WHERE id=joke)) " +
+                "WHERE joke=?",
+                (delta, delta, joke))
+
+    def refresh_ranks(self, max_age=0):
+        # decay the ranks if they are older than max_age seconds
+        if self._ranked_since(max_age):
+            return
+        # another request may have decayed them while we waited for the lock
+        self._begin()
+        if self._ranked_since(max_age):
+            self.conn.commit()
+            return
+        now = datetime.datetime.now()
+        self.c.execute("UPDATE " + self.prefix + "_tallies SET " +
+                       "rank=joke_rank(score, (SELECT created FROM " +
+                       self.prefix + "_jokes WHERE id=joke))")
+        self._changed()
+        self.c.execute("INSERT OR REPLACE INTO " + self.prefix + "_meta" +
+                       "(key, value) VALUES('ranked', ?)", (now.isoformat(),))
+        self.conn.commit()
+
+    def _ranked_since(self, max_age):
+        # ranks were decayed less than max_age seconds ago
+        refreshed = self.c.execute("SELECT value FROM " + self.prefix +
+                                   "_meta WHERE key='ranked'").fetchone()
+        return bool(refreshed and max_age and datetime.datetime.now() -
+                    datetime.datetime.fromisoformat(refreshed['value']) <
+                    datetime.timedelta(seconds=max_age))
+
+    def _tally_user(self, user, sign):
+        # add (or remove) all of a user's votes, used on role changes
+        votes = self.c.execute("SELECT joke, type FROM " + self.prefix +
+                               "_votes WHERE user=? AND type IN " +
+                               "('up', 'down')", (user,)).fetchall()
+        for vote in votes:
+            self._tally(vote['joke'], vote['type'], user, sign)
+
+    def check_query_plans(self):
+        # return the hot queries that do a full table scan or sort, or
+        # search a table without binding the key columns of the lookup
+        users = (self.prefix + "_users", "u")
+        votes = (self.prefix + "_votes", "v")
+        tallies = (self.prefix + "_tallies", "t")
+        meta = (self.prefix + "_meta",)
+        # (sql, args, table names, columns its searches must bind)
+        lookups = [
+            ("SELECT id FROM " + self.prefix + "_users " +
+             "WHERE role='guest' AND identifier=?", ('',), users,
+             ('identifier',)),
+            ("SELECT id FROM " + self.prefix + "_users " +
+             "WHERE identifier=?", ('',), users, ('identifier',)),
+            ("SELECT role FROM " + self.prefix + "_users WHERE id=?", (0,),
+             users, ('rowid',)),
+            ("SELECT type FROM " + self.prefix + "_votes " +
+             "WHERE joke=? AND user=? AND type IN ('up', 'down')", (0, 0),
+             votes, ('joke', 'user')),
+            ("SELECT COUNT(*) FROM " + self.prefix + "_votes " +
+             "WHERE joke=? AND user=? AND type='delete'", (0, 0),
+             votes, ('joke', 'user')),
+            ("SELECT joke, type FROM " + self.prefix + "_votes " +
+             "WHERE user=? AND type IN ('up', 'down')", (0,),
+             votes, ('user',)),
+            ("SELECT joke, type FROM " + self.prefix + "_votes " +
+             "WHERE type IN ('up', 'down') AND NOT user=? AND joke=?",
+             (0, 0), votes, ('joke',)),
+            ("SELECT * FROM " + self.prefix + "_tallies WHERE joke=?", (0,),
+             tallies, ('rowid',)),
+            ("SELECT value FROM " + self.prefix + "_meta " +
+             "WHERE key='version'", (), meta, ('key',)),
+        ]
+        # (sql, args, may walk an index, may sort, table names, keys)
+        checks = [(sql, args, False, False, table, keys)
+                  for sql, args, table, keys in lookups]
+        args = {'user': 0, 'iamroot': False, 'match': 'x', 'tag0': 'x',
+                'limit': 10}
+        for sortby in ('rank', 'score', 'unread', 'age'):
+            for match, tags in ((False, 0), (True, 0), (False, 1)):
+                # sorting the matches of a search or the user's votes is
+                # fine, the viewer's votes are looked up by user
+                listing, special, count = self.joke_queries(sortby, match,
+                                                            tags)
+                checks.append((listing + " LIMIT :limit", args, True,
+                               match or tags > 0, votes, ('user',)))
+                checks.append((special, args, False, True, votes, ('user',)))
+                checks.append((count, args, True, False, votes, ('user',)))
+        regressed = []
+        for sql, args, walk, sort, table, keys in checks:
+            plan = self.c.execute("EXPLAIN QUERY PLAN " + sql,
+                                  args).fetchall()
+            for step in plan:
+                detail = step['detail']
+                # an index range on a column like type alone walks
+                # most of the table
+                search = re.match(r"(SCAN|SEARCH) (\w+)( .*\((.*)\))?",
+                                  detail)
+                unbound = search is not None and \
+                    search.group(2) in table and \
+                    not all(key + '=' in (search.group(4) or '')
+                            for key in keys)
+                if detail.startswith('SCAN ') and ':M' not in detail and \
+                        not (walk and 'INDEX' in detail) or \
+                        'TEMP B-TREE' in detail and not sort or unbound:
+                    regressed.append(sql)
+                    break
+        return regressed
+
+    def scores(self, exclude_voter=None, jokeid=None):
         # exclude_voter (optional): do not count a user's votes
+        # jokeid (optional): only score this joke
+        # returns {joke id: score}, jokes without votes are missing
         if exclude_voter is None:
             exclude_voter = ""
 
-        users = self.c.execute("SELECT id FROM " + self.prefix +
-                               "_users WHERE role='user' " +
-                               "OR role='super'").fetchall()
-        users = [u['id'] for u in users]
-
-        votewhere = "SELECT COUNT(*) FROM " + self.prefix + "_votes WHERE "
-
-        # TODO optimize queries
-        # count guest votes
-        score = 0
-        score += self.c.execute(
-            votewhere + "joke=? AND NOT user=? AND type='up'",
-            (jokeid, exclude_voter)).fetchone()['COUNT(*)']
-        score -= self.c.execute(
-            votewhere + "joke=? AND NOT user=? AND type='down'",
-            (jokeid, exclude_voter)).fetchone()['COUNT(*)']
-
-        for user in users:
-            # user's scores count 3 times more
-            if user == exclude_voter:
-                continue
-            score += self.c.execute(
-                votewhere + "joke=? AND type='up' AND user=?",
-                (jokeid, user)).fetchone()['COUNT(*)'] * 2
-            score -= self.c.execute(
-                votewhere + "joke=? AND type='down' AND user=?",
-                (jokeid, user)).fetchone()['COUNT(*)'] * 2
-
-        return score
-
-    def get_jokes(self, user=None, search=None, sortby='rank'):
+        where = ""
+        args = (exclude_voter,)
+        if jokeid is not None:
+            where = "WHERE j.id=? "
+            args += (jokeid,)
+
+        # user's scores count 3 times more,
+        # the pre-v0 counters are guest votes like in tally_select
+        rows = self.c.execute(
+            "SELECT j.id AS joke, j.legacy_up-j.legacy_down+IFNULL(SUM(" +
+            "CASE v.type WHEN 'up' THEN 1 ELSE -1 END * " +
+            "CASE WHEN u.role IN ('user', 'super') THEN 3 ELSE 1 END" +
+            "), 0) AS score FROM " + self.prefix + "_jokes j " +
+            "LEFT JOIN " + self.prefix + "_votes v ON v.joke=j.id " +
+            "AND v.type IN ('up', 'down') AND NOT v.user=? " +
+            "LEFT JOIN " + self.prefix + "_users u ON u.id=v.user " +
+            where + "GROUP BY j.id " +
+            "HAVING COUNT(v.id) OR j.legacy_up OR j.legacy_down",
+            args).fetchall()
+        return {r['joke']: r['score'] for r in rows}
+
+    def score(self, jokeid, exclude_voter=None):
+        # exclude_voter (optional): do not count a user's votes
+        return self.scores(exclude_voter, jokeid).get(jokeid, 0)
+
+    @staticmethod
+    def render(text, fmt='prettytext'):
+        # returns html and editable text
+        if fmt == 'html':
+            return Markup().clean_html(text)
+        return Markup().prettify_text(text)
+
+    @staticmethod
+    def search_args(search):
+        # all words have to match, hashtags as whole tags (:tag0, :tag1, ...)
+        # and other words as prefixes of the indexed words (:match)
+        words = []
+        tags = set()
+        for word in search or []:
+            tag = re.fullmatch(r"#(\w+)", word)
+            if tag:
+                tags.add(tag.group(1).lower())
+            elif word:
+                words.append('"' + word.replace('"', '""') + '"*')
+        args = {'match': " AND ".join(words) or None,
+                'tags': tuple(sorted(tags))}
+        args.update(('tag%d' % n, tag) for n, tag in enumerate(args['tags']))
+        return args
+
+    def found(self, match, tags=0):
+        # condition on t.joke for jokes matching :match and tagged with
+        # the first tags of :tag0, :tag1, ...
+        condition = ""
+        if match:
+            condition += "t.joke IN (SELECT rowid FROM " + self.prefix + \
+                "_search WHERE " + self.prefix + "_search MATCH :match) AND "
+        for n in range(tags):
+            condition += "t.joke IN (SELECT joke FROM " + self.prefix + \
+                "_tags WHERE tag=:tag%d) AND " % n
+        return condition
+
+    def export_jokes(self, search=None, since=None):
+        # iterate over all jokes without deletion mark by score,
+        # since: only jokes created since this datetime
+        args = dict(self.search_args(search), since=since)
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT j.id, j.text, j.created, t.score, " +
+            "CASE WHEN u.role IN ('user', 'super') " +
+            "THEN u.identifier END AS author " +
+            "FROM " + self.prefix + "_tallies t " +
+            "CROSS JOIN " + self.prefix + "_jokes j ON j.id=t.joke " +
+            "LEFT JOIN " + self.prefix + "_users u ON u.id=j.user " +
+            "WHERE " + self.found(args['match'] is not None,
+                                  len(args['tags'])) +
+            ("j.created>=:since AND " if since is not None else "") +
+            "t.deleted=0 ORDER BY t.score DESC", args)
+        while True:
+            rows = cursor.fetchmany(500)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    def joke_queries(self, sortby, match=False, tags=0):
+        # listing: jokes without deletion mark, sorted, the same for everyone
+        # special: jokes with the user's votes (as votes) and deleted jokes
+        #   the user may see
+        # count: number of jokes without deletion mark
+        # parameters: :user, :iamroot, :match if match is set
+        #   and :tag0 up to the number of tags
+        columns = "SELECT j.*, t.score, t.rank, t.deleted"
+        tallies = self.prefix + "_tallies t "
+        jokes = self.prefix + "_jokes j "
+        votes = self.prefix + "_votes v "
+        select = columns + " FROM " + tallies + "CROSS JOIN " + jokes + \
+            "ON j.id=t.joke "
+        if sortby in ('unread', 'age'):
+            # walk the jokes by creation date
+            ordered = columns + " FROM " + jokes + "CROSS JOIN " + \
+                tallies + "ON t.joke=j.id "
+        else:
+            ordered = select
+        found = self.found(match, tags)
+        order = {
+            'rank': "t.rank DESC",
+            'score': "t.score DESC",
+            'unread': "j.created ASC",
+            'age': "j.created DESC"
+        }[sortby]
+        # a tag selects few jokes, looking them up and sorting them beats
+        # walking all jokes without deletion mark, so does counting matches
+        alive = "+t.deleted=0" if tags else "t.deleted=0"
+        listing = ordered + "WHERE " + found + alive + " ORDER BY " + order
+        special = columns + ", GROUP_CONCAT(v.type) AS votes FROM " + \
+            votes + "CROSS JOIN " + tallies + "ON t.joke=v.joke " + \
+            "CROSS JOIN " + jokes + "ON j.id=t.joke " + \
+            "WHERE " + found + "v.user=:user AND v.type IN ('up', 'down') " + \
+            "AND +t.deleted=0 GROUP BY v.joke UNION ALL " + \
+            columns + ", (SELECT GROUP_CONCAT(v.type) FROM " + votes + \
+            "WHERE v.joke=t.joke AND v.user=:user AND " + \
+            "v.type IN ('up', 'down')) AS votes FROM " + tallies + \
+            "CROSS JOIN " + jokes + "ON j.id=t.joke WHERE " + found + \
+            "t.deleted>0 AND (j.user=:user OR :iamroot)"
+        count = "SELECT COUNT(*) FROM " + tallies + "WHERE " + found + \
+            ("+t.deleted=0" if found else "t.deleted=0")
+        return listing, special, count
+
+    def listing(self, sortby, args, need):
+        # the sorted jokes without deletion mark and their number,
+        # at least need of them (all if None) unless there are less
+        listing, _, count = self.joke_queries(sortby,
+                                              args['match'] is not None,
+                                              len(args['tags']))
+        key = (sortby, args['match'], args['tags'])
+        version = None
+        if self.cache is not None:
+            version = self.data_version()
+            cached = self.cache.get(version, key)
+            if cached is not None:
+                jokes, complete, total = cached
+                if complete or need is not None and len(jokes) >= need:
+                    return jokes, total
+        limit = need
+        if version is not None and need is not None and \
+                need < self.cache.depth:
+            limit = self.cache.depth
+        if limit is not None:
+            listing += " LIMIT :limit"
+        jokes = self.c.execute(listing, dict(args, limit=limit)).fetchall()
+        total = self.c.execute(count, args).fetchone()['COUNT(*)']
+        if version is not None and limit in (None, self.cache.depth):
+            depth = self.cache.depth
+            self.cache.put(version, key, (jokes[:depth],
+                                          len(jokes) < depth, total))
+        return jokes, total
+
+    def get_jokes(self, user=None, search=None, sortby='rank',
+                  offset=0, limit=None, role=None):
         # user: return with user-specific attributes, also return deleted jokes
         # search: return jokes including all the specified words
         # sortby:
@@ -332,74 +1068,91 @@ class DBProxy(object):
         #   score - only score
         #   unread - without interaction first, then freshness
         #   age - freshness
-        ret_jokes = []
-        jokes = self.c.execute("SELECT * FROM " + self.prefix +
-                               "_jokes ORDER BY id ASC").fetchall()
-        votewhere = "SELECT COUNT(*) FROM " + self.prefix + "_votes WHERE "
-        iamroot = not self.c.execute("SELECT COUNT(*) FROM " + self.prefix +
-                                     "_users WHERE id=? AND role='super'",
-                                     (user,)).fetchone()['COUNT(*)'] == 0
-        now = datetime.datetime.now()
-        for joke in jokes:
-            ret_joke = {
-                'id': joke['id']
-            }
-            # mark jokes the user has already interacted with
-            ret_joke['upvoted'] = not self.c.execute(
-                votewhere + "joke=? AND user=? AND type='up'",
-                (joke['id'], user)).fetchone()['COUNT(*)'] == 0
-            ret_joke['downvoted'] = not self.c.execute(
-                votewhere + "joke=? AND user=? AND type='down'",
-                (joke['id'], user)).fetchone()['COUNT(*)'] == 0
-            # allow deletion
-            ret_joke['mine'] = (joke['user'] == user or iamroot)
-
-            if joke['format'] == 'prettytext':
-                ret_joke['html'], ret_joke['text'] = Markup().prettify_text(
-                    joke['text'])
-            if joke['format'] == 'html':
-                ret_joke['html'], ret_joke['text'] = Markup().clean_html(
-                    joke['text'])
-
-            if search is not None:  # simple search
-                match = True
-                for word in search:
-                    if word.lower() not in ret_joke['text'].lower():
-                        match = False
-                        break
-                if not match:
-                    continue
-
-            ret_joke['score'] = self.score(joke['id'], user)
-            ret_joke['freshness'] = (now - joke['created']).days
-
-            # skip other's jokes marked as deleted
-            if not self.c.execute("SELECT COUNT(*) FROM " + self.prefix +
-                                  "_votes WHERE type='delete' AND joke=?",
-                                  (joke['id'],)).fetchone()['COUNT(*)'] == 0:
-                # deleted
-                if ret_joke['mine']:
-                    ret_joke['deleted'] = True
-                    ret_joke['score'] = -100
-                else:
-                    continue
-
-            ret_jokes.append(ret_joke)
+        # offset, limit: only return this window of the sorted jokes
+        # role: the user's role if it is known already
+        # returns the jokes in the window and the number of all jokes
+        if role is None:
+            role = self.get_role(user)
+        iamroot = role == 'super'
+        weight = 3 if role in ('user', 'super') else 1
+        if sortby not in ('score', 'unread', 'age'):
+            sortby = 'rank'
+            if self.rank_refresh is not None:
+                self.refresh_ranks(self.rank_refresh)
+
+        args = dict(self.search_args(search), user=user, iamroot=iamroot)
+        # the user's votes and deletions change score and order
+        _, special, _ = self.joke_queries(sortby, args['match'] is not None,
+                                          len(args['tags']))
+        special = self.c.execute(special, args).fetchall()
+        mine = set(joke['id'] for joke in special)
+        # the listing is the same for everyone, so only the top of it
+        # has to be fetched
+        need = None
+        if limit is not None:
+            need = offset + limit + len(mine)
+        jokes, total = self.listing(sortby, args, need)
+        total += sum(1 for joke in special if joke['deleted'])
+
+        if need is not None:
+            # the listing is sorted, jokes after the first need of it
+            # cannot make it into the window
+            jokes = jokes[:need]
 
-        def sorter(j):
+        now = datetime.datetime.now()
+        ret_jokes = [JokeView(joke, None, weight, user, iamroot, now)
+                     for joke in jokes if joke['id'] not in mine]
+        # mark jokes the user has already interacted with
+        ret_jokes += [JokeView(joke, joke['votes'], weight, user, iamroot,
+                               now)
+                      for joke in special]
+
+        def sorter(joke):
             if sortby == 'unread':
-                return -j['freshness'] \
-                    if j['upvoted'] or j['downvoted'] \
-                    else j['freshness']
+                return -joke.freshness \
+                    if joke.upvoted or joke.downvoted \
+                    else joke.freshness
             if sortby == 'age':
-                return 1-j['freshness']
+                return 1-joke.freshness
             if sortby == 'score':
-                return j['score']
-            # 'rank' or invalid
-            return (j['score']+1)/pow(j['freshness']+1, 1.8)
+                return joke.score
+            if joke.id in mine:
+                return self.rank(joke.score, joke.freshness)
+            return joke.row['rank']
 
-        ret_jokes = sorted(ret_jokes, key=sorter, reverse=True)
-        return ret_jokes
+        if limit is None:
+            ret_jokes = sorted(ret_jokes, key=sorter, reverse=True)[offset:]
+        else:
+            # only the top of the list has to be sorted
+            ret_jokes = heapq.nlargest(offset + limit, ret_jokes,
+                                       key=sorter)[offset:]
+        return ret_jokes, total
+
+    @staticmethod
+    def viewer_votes(score, votes, weight):
+        # upvoted, downvoted and score of a joke with score and the
+        # viewer's votes (comma separated), the viewer's own votes do not
+        # count for the score
+        votes = (votes or '').split(',')
+        return ('up' in votes, 'down' in votes,
+                score - weight * (votes.count('up') - votes.count('down')))
+
+    def vote_state(self, joke, user, role=None):
+        # the joke's score and user's votes as get_jokes returns them,
+        # None if there is no such joke
+        if role is None:
+            role = self.get_role(user)
+        row = self.c.execute(
+            "SELECT t.score, (SELECT GROUP_CONCAT(v.type) FROM " +
+            self.prefix + "_votes v WHERE v.joke=t.joke AND v.user=? " +
+            "AND v.type IN ('up', 'down')) AS votes FROM " + self.prefix +
+            "_tallies t WHERE t.joke=?", (user, joke)).fetchone()
+        if row is None:
+            return None
+        upvoted, downvoted, score = self.viewer_votes(
+            row['score'], row['votes'], 3 if role in ('user', 'super') else 1)
+        return {'id': joke, 'upvoted': upvoted, 'downvoted': downvoted,
+                'score': score}
 
     def add_user(self, name, password):
         # allow words combined by '.', '-', ' '
@@ -413,11 +1166,15 @@ class DBProxy(object):
         self.c.execute("INSERT INTO " + self.prefix +
                        "_users(identifier, password, salt, role) " +
                        "VALUES(?, ?, ?, 'user')", (name, password, salt))
+        user = self.c.lastrowid
+        if name == self.root_name:
+            self.root_user(name)
         self.conn.commit()
-        return self.c.lastrowid
+        return user
 
-    def get_user(self, cookie=None, name=None, password=None):
-        # cookie != None: return or create guest uid
+    def get_user(self, cookie=None, name=None, password=None, create=True):
+        # cookie != None: return or create guest uid,
+        #   None if the guest does not exist and create is False
         # name != None: return user uid or -2 (not found)
         # name, password != None: uid, -2 (not found) or -1 (wrong password)
         if cookie is not None:
@@ -426,6 +1183,8 @@ class DBProxy(object):
                                   (cookie,)).fetchone()
             if user:  # existing guest
                 uid = user['id']
+            elif not create:
+                uid = None
             else:  # create guest
                 self.c.execute("INSERT INTO " + self.prefix +
                                "_users(identifier) VALUES(?)",
@@ -456,52 +1215,253 @@ class DBProxy(object):
 
         return uid
 
+    def gc_guests(self, batch=10000, dry_run=False):
+        # delete the guests without votes or jokes, batch per transaction,
+        # yields the running count
+        # dry_run: only count them
+        last = 0
+        count = 0
+        while True:
+            if not dry_run:
+                self.c.execute("BEGIN IMMEDIATE")
+            guests = [(row['id'],) for row in self.c.execute(
+                "SELECT id FROM " + self.prefix + "_users u " +
+                "WHERE id>? AND role='guest' AND NOT EXISTS (" +
+                "SELECT 1 FROM " + self.prefix + "_votes v " +
+                "WHERE v.user=u.id) AND id NOT IN (" +
+                "SELECT user FROM " + self.prefix + "_jokes " +
+                "WHERE user IS NOT NULL) ORDER BY id LIMIT ?",
+                (last, batch)).fetchall()]
+            if guests and not dry_run:
+                self.c.executemany("DELETE FROM " + self.prefix + "_users " +
+                                   "WHERE id=?", guests)
+                # sessions must not keep the ids of deleted guests
+                self.c.execute("UPDATE " + self.prefix + "_meta " +
+                               "SET value=value+1 WHERE key='users'")
+            self.conn.commit()
+            if not guests:
+                break
+            last = guests[-1][0]
+            count += len(guests)
+            yield count
+
+    def get_role(self, uid):
+        # role of the user, None if there is no such user
+        role = self.c.execute("SELECT role FROM " + self.prefix +
+                              "_users WHERE id=?", (uid,)).fetchone()
+        return role['role'] if role else None
+
     def root_user(self, name):
+        user = self.c.execute("SELECT id, role FROM " + self.prefix +
+                              "_users WHERE identifier=?", (name,)).fetchone()
+        if user is None or user['role'] == 'super':
+            return
         app.logger.warning("converting %s to superuser", name)
+        # re-weigh the user's votes
+        self._tally_user(user['id'], -1)
         self.c.execute("UPDATE " + self.prefix + "_users SET role='super' " +
-                       "WHERE identifier=?", (name,))
+                       "WHERE id=?", (user['id'],))
+        self.c.execute("UPDATE " + self.prefix + "_meta " +
+                       "SET value=value+1 WHERE key='users'")
+        self._tally_user(user['id'], 1)
         self.conn.commit()
 
     def add_joke(self, text, user):
+        html, text = self.render(text)
         self.c.execute(
             "INSERT INTO " + self.prefix + "_jokes" +
-            "(text, format, user, created) " +
-            "VALUES(?, 'prettytext', ?, ?)",
-            (text, user, datetime.datetime.now()))
+            "(text, html, format, user, created) " +
+            "VALUES(?, ?, 'prettytext', ?, ?)",
+            (text, html, user, datetime.datetime.now()))
+        joke = self.c.lastrowid
+        self.c.execute("INSERT INTO " + self.prefix + "_tallies(joke) " +
+                       "VALUES(?)", (joke,))
+        self.index_joke(joke, text)
+        self._changed()
         self.conn.commit()
 
     def update_joke(self, text, joke):
+        html, text = self.render(text)
         self.c.execute("UPDATE " + self.prefix + "_jokes " +
-                       "SET text=?, format='prettytext' WHERE id=?",
-                       (text, joke))
+                       "SET text=?, html=?, format='prettytext' WHERE id=?",
+                       (text, html, joke))
+        self.index_joke(joke, text)
+        self._changed()
         self.conn.commit()
 
+    def import_jokes(self, jokes, batch=10000):
+        # jokes: iterable of (line, joke), joke is a dict with text,
+        #   optional created (ISO date) and author (name of a registered
+        #   user) or the ValueError its line could not be read with
+        # inserts batch jokes per transaction, a batch is checked before
+        # its transaction begins and bad jokes are skipped
+        # yields the running count and the (line, reason) of skipped jokes
+        authors = {}
+        count = 0
+        jokes = iter(jokes)
+        while True:
+            chunk = list(itertools.islice(jokes, batch))
+            if not chunk:
+                break
+            now = datetime.datetime.now()
+            rows = []
+            skipped = []
+            for line, joke in chunk:
+                try:
+                    if isinstance(joke, ValueError):
+                        raise joke
+                    if not isinstance(joke, dict) or not joke.get('text'):
+                        raise ValueError("no text")
+                    html, text = self.render(joke['text'])
+                    created = now
+                    if joke.get('created'):
+                        created = datetime.datetime.fromisoformat(
+                            joke['created'])
+                    rank = self.rank(0, (now - created).days)
+                    name = str(joke.get('author') or '').lower()
+                except (ValueError, TypeError) as error:
+                    skipped.append((line, str(error)))
+                    continue
+                if name not in authors:
+                    user = self.get_user(name=name) if name else -2
+                    authors[name] = user if user >= 0 else None
+                rows.append((text, html, authors[name], created, rank))
+            if rows:
+                # nobody else may take ids while the batch is written
+                self.c.execute("BEGIN IMMEDIATE")
+                first = self.c.execute("SELECT IFNULL(MAX(id), 0)+1 AS id " +
+                                       "FROM " + self.prefix +
+                                       "_jokes").fetchone()['id']
+                rows = [(joke_id,) + row
+                        for joke_id, row in enumerate(rows, first)]
+                self.c.executemany(
+                    "INSERT INTO " + self.prefix + "_jokes" +
+                    "(id, text, html, format, user, created) " +
+                    "VALUES(?, ?, ?, 'prettytext', ?, ?)",
+                    [row[:5] for row in rows])
+                self.c.executemany("INSERT INTO " + self.prefix +
+                                   "_tallies(joke, rank) VALUES(?, ?)",
+                                   [(row[0], row[5]) for row in rows])
+                self.c.executemany("INSERT INTO " + self.prefix + "_search" +
+                                   "(rowid, text) VALUES(?, ?)",
+                                   [row[:2] for row in rows])
+                self.c.executemany("INSERT INTO " + self.prefix + "_tags" +
+                                   "(tag, joke) VALUES(?, ?)",
+                                   [(tag, row[0]) for row in rows
+                                    for tag in Markup.hashtags(row[1])])
+                self._changed()
+                self.conn.commit()
+            count += len(rows)
+            yield count, skipped
+
+    def index_joke(self, joke, text):
+        self.c.execute("DELETE FROM " + self.prefix + "_search " +
+                       "WHERE rowid=?", (joke,))
+        self.c.execute("INSERT INTO " + self.prefix + "_search(rowid, text) " +
+                       "VALUES(?, ?)", (joke, text))
+        self.c.execute("DELETE FROM " + self.prefix + "_tags WHERE joke=?",
+                       (joke,))
+        self.c.executemany("INSERT INTO " + self.prefix + "_tags(tag, joke) " +
+                           "VALUES(?, ?)",
+                           [(tag, joke) for tag in Markup.hashtags(text)])
+
+    def top_tags(self, limit=10):
+        # the most used tags of the jokes without deletion mark
+        # as [{'tag': tag, 'count': number of jokes}]
+        version = None
+        if self.cache is not None:
+            version = self.data_version()
+            cached = self.cache.get(version, ('tags', limit))
+            if cached is not None:
+                return cached
+        tags = self.c.execute(
+            "SELECT g.tag, COUNT(*) AS count " +
+            "FROM " + self.prefix + "_tags g " +
+            "CROSS JOIN " + self.prefix + "_tallies t ON t.joke=g.joke " +
+            "WHERE t.deleted=0 GROUP BY g.tag " +
+            "ORDER BY count DESC, g.tag LIMIT ?", (limit,)).fetchall()
+        if version is not None:
+            self.cache.put(version, ('tags', limit), tags)
+        return tags
+
     def remove_joke(self, joke, user):
+        self._begin()
         self.c.execute(
             "INSERT INTO " + self.prefix + "_votes(joke, user, type) " +
-            "VALUES(?, ?, 'delete')", (joke, user))
+            "VALUES(?, ?, 'delete') ON CONFLICT(joke, user) " +
+            "WHERE type='delete' DO NOTHING", (joke, user))
+        if self.c.rowcount:
+            self._tally(joke, 'delete', user)
+        self.conn.commit()
+
+    def undelete_joke(self, joke, user):
+        # remove the user's deletion mark
+        self._begin()
+        self.c.execute("DELETE FROM " + self.prefix + "_votes " +
+                       "WHERE joke=? AND user=? AND type='delete'",
+                       (joke, user))
+        if self.c.rowcount:
+            self._tally(joke, 'delete', user, -1)
         self.conn.commit()
 
+    def _begin(self):
+        # votes read the old vote before they write,
+        # nobody else may write in between
+        if not self.conn.in_transaction:
+            self.c.execute("BEGIN IMMEDIATE")
+
+    def _own_vote(self, joke, user):
+        vote = self.c.execute("SELECT type FROM " + self.prefix + "_votes " +
+                              "WHERE joke=? AND user=? AND " +
+                              "type IN ('up', 'down')",
+                              (joke, user)).fetchone()
+        return vote['type'] if vote else None
+
     def vote_joke(self, joke, down, user):
+        self._begin()
+        self._vote(joke, down, user)
+        self.conn.commit()
+
+    def _vote(self, joke, down, user):
+        # a new vote replaces the user's old vote on the joke
+        vtype = 'down' if down else 'up'
+        old = self._own_vote(joke, user)
+        if old == vtype:
+            return
         self.c.execute(
             "INSERT INTO " + self.prefix + "_votes(joke, user, type) " +
-            "VALUES(?, ?, ?)", (joke, user, 'down' if down else 'up'))
-        self.conn.commit()
+            "VALUES(?, ?, ?) ON CONFLICT(joke, user) " +
+            "WHERE type IN ('up', 'down') DO UPDATE SET type=excluded.type",
+            (joke, user, vtype))
+        if old is not None:
+            self._tally(joke, old, user, -1)
+        self._tally(joke, vtype, user)
 
     def unvote_joke(self, joke, user):
-        self.c.execute("DELETE FROM " + self.prefix + "_votes " +
-                       "WHERE joke=? AND user=?", (joke, user))
+        self._begin()
+        self._unvote(joke, user)
         self.conn.commit()
 
-    def has_voted(self, joke, user):
-        return not self.c.execute("SELECT COUNT(*) FROM " + self.prefix +
-                                  "_votes WHERE joke=? AND user=?",
-                                  (joke, user)).fetchone()['COUNT(*)'] == 0
+    def _unvote(self, joke, user):
+        old = self._own_vote(joke, user)
+        if old is None:
+            return
+        self.c.execute("DELETE FROM " + self.prefix + "_votes " +
+                       "WHERE joke=? AND user=? AND type IN ('up', 'down')",
+                       (joke, user))
+        self._tally(joke, old, user, -1)
+
+    def apply_votes(self, votes):
+        # cast the votes of (joke, down, user) in one transaction
+        self._begin()
+        for joke, down, user in votes:
+            self._vote(joke, down, user)
+        self.conn.commit()
 
-    def may_modify_joke(self, joke, user):
-        if self.c.execute("SELECT role FROM " + self.prefix +
-                          "_users WHERE id=?",
-                          (user,)).fetchone()['role'] == 'super':
+    def may_modify_joke(self, joke, user, role=None):
+        if role is None:
+            role = self.get_role(user)
+        if role == 'super':
             return True
         if self.c.execute("SELECT user FROM " + self.prefix +
                           "_jokes WHERE id=?",
@@ -510,31 +1470,547 @@ class DBProxy(object):
         return False
 
 
+class JokeCache(object):
+    # listings of jokes, valid as long as the data version does not change
+    def __init__(self, depth, size=32):
+        # depth: maximum number of jokes per listing
+        # size: maximum number of listings
+        self.depth = depth
+        self.size = size
+        self.lock = threading.Lock()
+        self.version = None
+        self.listings = collections.OrderedDict()
+
+    def get(self, version, key):
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.listings.clear()
+                return None
+            if key not in self.listings:
+                return None
+            self.listings.move_to_end(key)
+            return self.listings[key]
+
+    def put(self, version, key, listing):
+        with self.lock:
+            if version != self.version:
+                return
+            self.listings[key] = listing
+            if len(self.listings) > self.size:
+                self.listings.popitem(last=False)
+
+
+class DBPool(object):
+    def __init__(self, database, rootName, size=4, timeout=10,
+                 cache_depth=1000, **options):
+        # size: maximum number of open connections
+        # timeout: seconds to wait for a free connection
+        # cache_depth: jokes per cached listing, 0 disables the cache
+        # options: passed to DBProxy
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.options = options
+        self.options['root_name'] = rootName
+        if cache_depth:
+            self.options['cache'] = JokeCache(cache_depth)
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.opened = 0
+
+        # not kept, workers forked after the import must not share it
+        proxy = DBProxy(self.database, **self.options)
+        proxy.setup()
+        proxy.close()
+
+    def get(self):
+        # borrow a connection, None if there is none free in time
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            connect = self.opened < self.size
+            if connect:
+                self.opened += 1
+        if connect:
+            return DBProxy(self.database, **self.options)
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            return None
+
+    def put(self, proxy):
+        # discard what an aborted request left behind
+        proxy.conn.rollback()
+        self.idle.put(proxy)
+
+
+class VoteQueue(object):
+    # group commit: votes arriving within a window are written in one
+    # transaction, every voter waits for the commit of their vote
+    def __init__(self, dbpool, window):
+        # window: milliseconds to collect votes for
+        self.pool = dbpool
+        self.window = window / 1000
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, joke, down, user):
+        with self.lock:
+            # started lazily so forking servers get their own thread
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        done = threading.Event()
+        result = {}
+        self.pending.put(((joke, down, user), done, result))
+        done.wait()
+        if 'error' in result:
+            raise result['error']
+
+    def collect(self):
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.window
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return batch
+            try:
+                batch.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                return batch
+
+    def run(self):
+        # the writer has its own connection, the voters hold pool connections
+        proxy = DBProxy(self.pool.database, **self.pool.options)
+        while True:
+            batch = self.collect()
+            try:
+                proxy.apply_votes([vote for vote, _, _ in batch])
+            except Exception as error:  # pylint: disable=broad-except
+                proxy.conn.rollback()
+                for _, _, result in batch:
+                    result['error'] = error
+            for _, done, _ in batch:
+                done.set()
+
+
+class Snapshot(object):
+    # read-only copy of the database in memory, shared by the requests of
+    # this process and replaced as a whole when the data version changes
+    generations = itertools.count(1)
+
+    def __init__(self, dbpool, staleness):
+        # staleness: seconds between two checks of the data version
+        self.pool = dbpool
+        self.staleness = staleness
+        # the copy's ranks are decayed on the database before it is copied
+        self.options = dict(dbpool.options, rank_refresh=None, uri=True)
+        if 'cache' in self.options:
+            # listings of the copy may lag behind those of the database
+            self.options['cache'] = JokeCache(self.options['cache'].depth)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.source = None
+        # generation, data version, uri, connection keeping the copy alive
+        self.current = None
+        self.idle = queue.LifoQueue()
+
+    def get(self):
+        # borrow a connection to the current copy
+        with self.lock:
+            # started lazily so forking servers get their own thread and copy
+            if self.thread is None or not self.thread.is_alive():
+                self.source = DBProxy(self.pool.database, **self.pool.options)
+                self.load()
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        generation, version, uri, _ = self.current
+        while True:
+            try:
+                proxy = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if proxy.generation == generation:
+                return proxy
+            proxy.close()
+        proxy = DBProxy(uri, **self.options)
+        proxy.c.execute("PRAGMA query_only=1")
+        proxy.generation = generation
+        proxy.version = version
+        return proxy
+
+    def put(self, proxy):
+        proxy.conn.rollback()
+        if proxy.generation == self.current[0]:
+            self.idle.put(proxy)
+        else:
+            proxy.close()
+
+    def load(self):
+        # copy the database if its data version changed
+        start = time.monotonic()
+        if self.pool.options.get('rank_refresh') is not None:
+            self.source.refresh_ranks(self.pool.options['rank_refresh'])
+        if self.current is not None and \
+                self.current[1] == int(self.source.data_version()):
+            self.source.conn.rollback()
+            return
+        generation = next(self.generations)
+        uri = "file:jokevote-%d-%d?mode=memory&cache=shared" % (
+            os.getpid(), generation)
+        keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.source.conn.backup(keeper)
+        # the version of the copy, writes may have happened since the check
+        version = int(keeper.execute(
+            "SELECT value FROM " + self.source.prefix + "_meta " +
+            "WHERE key='version'").fetchone()[0])
+        previous, self.current = self.current, (generation, version, uri,
+                                                keeper)
+        if previous is not None:
+            # borrowed connections keep the previous copy until returned
+            previous[3].close()
+        app.logger.info("loaded snapshot of version %s in %.1fs", version,
+                        time.monotonic() - start)
+
+    def run(self):
+        while True:
+            time.sleep(self.staleness)
+            try:
+                self.load()
+            except Exception:  # pylint: disable=broad-except
+                self.source.conn.rollback()
+                app.logger.exception("loading the snapshot failed")
+
+
+class RateLimiter(object):
+    # token buckets by key, requests beyond rate per second are rejected
+    # once a key used up its burst, per process
+    def __init__(self, rate, burst=10, size=10000):
+        # rate: tokens added to a bucket per second
+        # burst: tokens a bucket holds at most
+        # size: maximum number of buckets, the least recently used
+        #   are forgotten first
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self.lock = threading.Lock()
+        self.buckets = collections.OrderedDict()  # key: (tokens, time)
+        self.rejected = collections.Counter()  # kind of key: requests
+
+    def allow(self, kind, key):
+        # take a token from the bucket of key, False if there is none
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop((kind, key), (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            else:
+                self.rejected[kind] += 1
+            self.buckets[(kind, key)] = (tokens, now)
+            if len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+        return allowed
+
+    def lines(self):
+        yield "# HELP jokevote_rate_limited_total " + \
+            "Writes rejected by the rate limiter."
+        yield "# TYPE jokevote_rate_limited_total counter"
+        with self.lock:
+            rejected = sorted(self.rejected.items())
+        for kind, count in rejected:
+            yield 'jokevote_rate_limited_total{key="%s"} %d' % (kind, count)
+
+
+class Histogram(object):
+    # cumulative histogram by endpoint in the Prometheus text format
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.series = {}  # endpoint: (counts per bucket, sum, count)
+        self.lock = threading.Lock()
+
+    def observe(self, endpoint, value):
+        with self.lock:
+            counts, total, count = self.series.get(
+                endpoint, ([0] * len(self.buckets), 0, 0))
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+            self.series[endpoint] = (counts, total + value, count + 1)
+
+    def lines(self):
+        yield "# HELP " + self.name + " " + self.description
+        yield "# TYPE " + self.name + " histogram"
+        with self.lock:
+            series = sorted(self.series.items())
+        for endpoint, (counts, total, count) in series:
+            label = 'endpoint="' + endpoint + '"'
+            for bound, bucket in zip(self.buckets, counts):
+                yield "%s_bucket{%s,le=\"%s\"} %d" % (self.name, label,
+                                                     bound, bucket)
+            yield "%s_bucket{%s,le=\"+Inf\"} %d" % (self.name, label, count)
+            yield "%s_sum{%s} %s" % (self.name, label, total)
+            yield "%s_count{%s} %d" % (self.name, label, count)
+
+
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+histograms = {
+    'duration': Histogram("jokevote_request_seconds",
+                          "Time to answer a request.", SECONDS),
+    'statements': Histogram("jokevote_request_statements",
+                            "SQL statements run by a request.",
+                            (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)),
+    'db_time': Histogram("jokevote_request_db_seconds",
+                         "Time a request spent in the database.", SECONDS),
+    'commits': Histogram("jokevote_request_commits",
+                         "Commits by a request.", (0, 1, 2, 5, 10)),
+    'render': Histogram("jokevote_request_render_seconds",
+                        "Time a request spent rendering templates.", SECONDS)
+}
+
+
 def db():
     database = getattr(g, "_database", None)
     if database is None:
-        database = g._database = DBProxy(config['database'],
-                                         config['superuser'].lower())
+        database = pool.get()
+        if database is None:
+            abort(503)
+        database.conn.reset()
+        g._database = database
     return database
 
+
+def reader():
+    # connection for pages and exports, the snapshot if there is one,
+    # unless it lags behind the visitor's own writes
+    database = getattr(g, "_snapshot", None)
+    if database is None:
+        if snapshot is None:
+            return db()
+        database = snapshot.get()
+        database.conn.reset()
+        g._snapshot = database
+    if database.version < session.get('written', 0):
+        return db()
+    return database
+
+
+def borrowed():
+    # the connections the request holds
+    return [database for database in (getattr(g, "_database", None),
+                                      getattr(g, "_snapshot", None))
+            if database is not None]
+
 app = Flask(__name__)
 
 
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+    g.render_time = 0.0
+
+
+def record_request(endpoint, path, started, render_time, databases):
+    duration = time.perf_counter() - started
+    statements, commits, db_time, slowest = 0, 0, 0.0, (0.0, None)
+    for database in databases:
+        conn = database.conn
+        statements += conn.statements
+        commits += conn.commits
+        db_time += conn.db_time
+        slowest = max(slowest, conn.slowest, key=lambda slow: slow[0])
+    histograms['duration'].observe(endpoint, duration)
+    histograms['statements'].observe(endpoint, statements)
+    histograms['db_time'].observe(endpoint, db_time)
+    histograms['commits'].observe(endpoint, commits)
+    histograms['render'].observe(endpoint, render_time)
+    slow = config.get('slow_request')
+    if slow is not None and duration >= slow:
+        app.logger.warning("slow request %s (%.1fms): %d statements, " +
+                           "%.1fms in the database, slowest (%.1fms): %s",
+                           path, duration * 1000, statements,
+                           db_time * 1000, slowest[0] * 1000, slowest[1])
+
+
+@app.after_request
+def timing_header(response):
+    databases = borrowed()
+    if config.get('timing_header') and databases:
+        # streamed responses only report the work until the first chunk
+        response.headers.set(
+            'Server-Timing',
+            'db;dur=%.1f;desc="%d statements, %d commits", '
+            'render;dur=%.1f, total;dur=%.1f' % (
+                sum(database.conn.db_time for database in databases) * 1000,
+                sum(database.conn.statements for database in databases),
+                sum(database.conn.commits for database in databases),
+                g.render_time * 1000,
+                (time.perf_counter() - g.started) * 1000))
+    if response.is_streamed:
+        # the stream keeps reading from the connections after the teardown,
+        # record and return them once the response is closed
+        finish = (request.endpoint or "none", request.full_path,
+                  g.pop('started'), g.render_time, databases)
+        g.pop('_database', None)
+        g.pop('_snapshot', None)
+
+        def close():
+            record_request(*finish)
+            release(databases)
+        response.call_on_close(close)
+    return response
+
+
+@app.after_request
+def remember_write(response):
+    # the visitor's next pages are read from the database until the
+    # snapshot includes their write
+    if snapshot is not None and request.method == 'POST' and \
+            response.status_code < 400:
+        session['written'] = int(db().data_version())
+    return response
+
+
+# endpoints that write, guarded by the rate limiter
+WRITES = ('submit', 'edit', 'upvote', 'downvote', 'delete', 'undelete',
+          'login', 'api_vote')
+
+
+@app.before_request
+def limit_writes():
+    # shed floods before they reach the database, by client address
+    # (set the proxies option behind a reverse proxy) and, for visitors
+    # with a session, by visitor
+    if limiter is None or request.endpoint not in WRITES:
+        return
+    login = visitor_login()
+    if not limiter.allow('address', request.remote_addr) or \
+            login is not None and not limiter.allow('visitor', login):
+        abort(429, retry_after=max(1, int(math.ceil(1 / limiter.rate))))
+
+
+@app.teardown_request
+def teardown_request(exception):  # pylint: disable=unused-argument
+    if 'started' in g:
+        record_request(request.endpoint or "none", request.full_path,
+                       g.pop('started'), g.render_time, borrowed())
+
+
+def release(databases):
+    for database in databases:
+        if getattr(database, 'generation', None) is not None:
+            snapshot.put(database)
+        else:
+            pool.put(database)
+
+
 @app.teardown_appcontext
 def close_db(exception):  # pylint: disable=unused-argument
-    database = getattr(g, "_database", None)
-    if database is not None:
-        database.close()
+    release(borrowed())
+
+
+@app.route('/metrics')
+def metrics():
+    lines = []
+    for histogram in histograms.values():
+        lines.extend(histogram.lines())
+    if limiter is not None:
+        lines.extend(limiter.lines())
+    return Response("\n".join(lines) + "\n",
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def identity(create=False):
+    # uid and role of the visitor, resolved once per request and
+    # remembered in the session until a role changes
+    # create: create the guest before its first write, guests that only
+    #   read have no row and the uid None
+    if 'identity' in g and (g.identity[0] is not None or not create):
+        return g.identity
+    if not create and anonymous():
+        # nothing to remember, the response stays cacheable
+        g.identity = None, None
+        return g.identity
+    if 'guestlogin' not in session:
+        session['guestlogin'] = os.urandom(32).hex()
+    login = visitor_login()
+    version = db().users_version()
+    cached = session.get('identity')
+    # writers check that their guest row still exists, see gc_guests
+    if cached and cached[0] == login and cached[1] == version and \
+            not (create and cached[3] not in ('user', 'super')):
+        g.identity = cached[2], cached[3]
+        return g.identity
+
+    uid = -2
+    if 'userlogin' in session:
+        uid = db().get_user(name=session['userlogin'].lower())
+    if uid < 0:
+        uid = db().get_user(cookie=session['guestlogin'], create=create)
+        g.identity = uid, 'guest' if uid is not None else None
+    else:
+        g.identity = uid, db().get_role(uid)
+    session['identity'] = [login, version, uid, g.identity[1]]
+    return g.identity
 
 
-def userid():
+def visitor_login():
+    # the member's name or the guest's cookie, None for anonymous visitors
     if 'userlogin' in session:
-        uid = db().get_user(name=session['userlogin'].lower())
-        if uid != -2:
-            return uid
-    if 'guestlogin' not in session:
-        session['guestlogin'] = os.urandom(32).hex()
-    return db().get_user(cookie=session['guestlogin'])
+        return 'user:' + session['userlogin'].lower()
+    if 'guestlogin' in session:
+        return 'guest:' + session['guestlogin']
+    return None
+
+
+def userid(create=False):
+    return identity(create)[0]
+
+
+def anonymous():
+    # visitors who never wrote or logged in all see the same pages
+    return 'guestlogin' not in session and 'userlogin' not in session
+
+
+def cache_state(viewer):
+    # ETag and Last-Modified of the response to this request for viewer,
+    # None if the response must not be cached
+    if '_flashes' in session:
+        return None
+    version, modified = reader().data_state()
+    etag = hashlib.sha1(repr((version, viewer, request.full_path))
+                        .encode('utf-8')).hexdigest()
+    return etag, modified
+
+
+def not_modified(state):
+    # 304 if the client has the current response already, before any of
+    # it is computed
+    if state is None or not request.if_none_match.contains(state[0]):
+        return None
+    return conditional(make_response("", 304), state)
+
+
+def conditional(response, state):
+    if state is None:
+        return response
+    response.set_etag(state[0])
+    response.last_modified = state[1]
+    if anonymous():
+        # the same for every anonymous visitor, reverse proxies may share it
+        response.cache_control.public = True
+        response.cache_control.max_age = config.get('cache_max_age', 60)
+    else:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
 
 
 @app.route('/')
@@ -542,42 +2018,151 @@ def root():
     return page(0)
 
 
-@app.route('/page/<int:num>')
-def page(num):
-    search = request.args.get('filter')
-    sortmethod = str(request.args.get('sort')) or 'rank'
+def search_words(search=None):
+    # search: the filter parameter, from the request by default
+    if search is None:
+        search = request.args.get('filter')
     if search:
         # TODO find a cleaner way
         # visual: #, actual: _
         search = re.sub(r"^" + Markup.tagmark, "#", search)
         search = search.split(Markup.spacemark)
+    return search
+
+
+@app.route('/page/<int:num>')
+def page(num):
+    search = search_words()
+    sortmethod = str(request.args.get('sort')) or 'rank'
     perpage = abs(int(request.args.get('perpage') or 10))
-    jokes = db().get_jokes(user=userid(), search=search, sortby=sortmethod)
+    uid, role = identity()
+    state = cache_state((uid, role, session.get('userlogin')))
+    cached = not_modified(state)
+    if cached is not None:
+        return cached
+    jokes, total = reader().get_jokes(user=uid, search=search,
+                                      sortby=sortmethod,
+                                      offset=num*perpage, limit=perpage,
+                                      role=role)
+    toptags = reader().top_tags()
     user = {'loggedin': False}
     if 'userlogin' in session:
         user['loggedin'] = True
         user['name'] = session['userlogin']
-    resp = make_response(
-        render_template(
-            'index.html',
-            currentpage=num,
-            tags=search,
-            perpage=perpage,
-            jokes=jokes,
-            abusemail=config['abusemail'],
-            title=config['title'],
-            featured=config['featured'],
-            user=user))
+    start = time.perf_counter()
+    html = render_template(
+        'index.html',
+        currentpage=num,
+        tags=search,
+        perpage=perpage,
+        jokes=jokes,
+        total=total,
+        abusemail=config['abusemail'],
+        title=config['title'],
+        featured=config['featured'],
+        toptags=toptags,
+        user=user)
+    g.render_time += time.perf_counter() - start
+    resp = make_response(html)
     resp.headers.set('X-SmoothState-Location',
                      request.path + "?" +
                      str(request.query_string, "utf-8"))
-    return resp
+    return conditional(resp, state)
+
+
+API_FIELDS = ('id', 'text', 'html', 'score', 'freshness', 'upvoted',
+              'downvoted', 'mine', 'deleted')
+
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(
+        json.dumps(position).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        offset, sortmethod, search = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        abort(400)
+    if not isinstance(offset, int) or offset < 0 or \
+            not isinstance(sortmethod, str) or not isinstance(search, str):
+        abort(400)
+    return offset, sortmethod, search
+
+
+@app.route('/api/jokes')
+def api_jokes():
+    # sort, filter: like page()
+    # limit: jokes per response, at least 1 and at most 100
+    # fields: comma separated subset of API_FIELDS
+    # cursor: continue after the previous response, carries sort and filter
+    # returns the jokes, their total and the cursor of the next ones
+    #   (None at the end)
+    # the cursor is a position in the order, jokes may shift when
+    # the votes change between two requests
+    if request.args.get('cursor'):
+        offset, sortmethod, search = decode_cursor(request.args['cursor'])
+    else:
+        offset = 0
+        sortmethod = request.args.get('sort') or 'rank'
+        search = request.args.get('filter') or ''
+    try:
+        limit = min(int(request.args.get('limit') or 20), 100)
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        # an empty window would point the cursor at itself
+        abort(400)
+    fields = API_FIELDS
+    if request.args.get('fields'):
+        fields = request.args['fields'].split(',')
+        if not set(fields) <= set(API_FIELDS):
+            abort(400)
+
+    uid, role = identity()
+    state = cache_state((uid, role, session.get('userlogin')))
+    cached = not_modified(state)
+    if cached is not None:
+        return cached
+    jokes, total = reader().get_jokes(user=uid,
+                                      search=search_words(search),
+                                      sortby=sortmethod, offset=offset,
+                                      limit=limit, role=role)
+    following = None
+    if offset + len(jokes) < total and len(jokes) == limit:
+        following = encode_cursor([offset + limit, sortmethod, search])
+    return conditional(jsonify(
+        jokes=[dict((field, getattr(joke, field)) for field in fields)
+               for joke in jokes],
+        total=total,
+        next=following), state)
+
+
+@app.route('/api/vote', methods=['POST'])
+def api_vote():
+    # id, down (true or false) as JSON or form,
+    # returns the joke's score and the viewer's votes like /api/jokes
+    data = request.get_json(silent=True) or request.form
+    try:
+        joke = int(data['id'])
+    except (KeyError, ValueError, TypeError):
+        abort(400)
+    down = data.get('down') in (True, 1, '1', 'true')
+    uid, role = identity(create=True)
+    if db().vote_state(joke, uid, role) is None:
+        abort(404)
+    if votes is not None:
+        votes.submit(joke, down, uid)
+    else:
+        db().apply_votes([(joke, down, uid)])
+    return jsonify(db().vote_state(joke, uid, role))
 
 
 @app.route('/submit', methods=['POST'])
 def submit():
     text = request.form['text']
-    db().add_joke(text, userid())
+    db().add_joke(text, userid(create=True))
     return redirect(request.referrer)
 
 
@@ -585,45 +2170,52 @@ def submit():
 def edit():
     text = request.form['text']
     joke = int(request.form['id'])
-    if not db().may_modify_joke(joke, userid()):
+    uid, role = identity(create=True)
+    if not db().may_modify_joke(joke, uid, role):
         abort(403)
     db().update_joke(text, joke)
     return redirect(request.referrer)
 
 
-@app.route('/upvote', methods=['POST'])
-def upvote():
+def vote(down):
     joke = int(request.form['id'])
-    if db().has_voted(joke, userid()):
-        db().unvote_joke(joke, userid())
-    db().vote_joke(joke, False, userid())
+    uid, role = identity(create=True)
+    if db().vote_state(joke, uid, role) is None:
+        abort(404)
+    if votes is not None:
+        votes.submit(joke, down, uid)
+    else:
+        db().apply_votes([(joke, down, uid)])
     return redirect(request.referrer)
 
 
+@app.route('/upvote', methods=['POST'])
+def upvote():
+    return vote(False)
+
+
 @app.route('/downvote', methods=['POST'])
 def downvote():
-    joke = int(request.form['id'])
-    if db().has_voted(joke, userid()):
-        db().unvote_joke(joke, userid())
-    db().vote_joke(joke, True, userid())
-    return redirect(request.referrer)
+    return vote(True)
 
 
 @app.route('/delete', methods=['POST'])
 def delete():
     joke = int(request.form['id'])
-    if not db().may_modify_joke(joke, userid()):
+    uid, role = identity(create=True)
+    if not db().may_modify_joke(joke, uid, role):
         abort(403)
-    db().remove_joke(joke, userid())
+    db().remove_joke(joke, uid)
     return redirect(request.referrer)
 
 
 @app.route('/undelete', methods=['POST'])
 def undelete():
     joke = int(request.form['id'])
-    if not db().may_modify_joke(joke, userid()):
+    uid, role = identity(create=True)
+    if not db().may_modify_joke(joke, uid, role):
         abort(403)
-    db().unvote_joke(joke, userid())
+    db().undelete_joke(joke, uid)
     return redirect(request.referrer)
 
 
@@ -658,14 +2250,161 @@ def logout():
     return redirect(request.referrer)
 
 
+def export_txt(jokes):
+    for cnt, joke in enumerate(jokes):
+        yield ("\n\r\n\r" if cnt else "") + joke['text']
+
+
+def export_jsonl(jokes):
+    for joke in jokes:
+        yield json.dumps({
+            'id': joke['id'],
+            'score': joke['score'],
+            'created': joke['created'].isoformat(),
+            'author': joke['author'],
+            'text': joke['text']
+        }) + "\n"
+
+
+def export_csv(jokes):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['id', 'score', 'created', 'author', 'text'])
+    for joke in jokes:
+        writer.writerow([joke['id'], joke['score'],
+                         joke['created'].isoformat(), joke['author'],
+                         joke['text']])
+        if out.tell() > 65536:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue()
+
+
+exporters = {
+    'txt': (export_txt, 'text/plain; charset=utf-8'),
+    'jsonl': (export_jsonl, 'application/x-ndjson; charset=utf-8'),
+    'csv': (export_csv, 'text/csv; charset=utf-8')
+}
+
+
 @app.route('/export')
 def export():
-    search = request.args.get('filter')
-    jokes = db().get_jokes(search=search, sortby='score')
-    texts = [j['text'] for j in jokes]
-    res = make_response("\n\r\n\r".join(texts))
-    res.headers['Content-Type'] = 'text/plain; charset=utf-8'
-    return res
+    # format: txt, jsonl or csv
+    # since: only jokes created since this ISO date
+    fmt = request.args.get('format') or 'txt'
+    if fmt not in exporters:
+        abort(400)
+    since = request.args.get('since')
+    if since:
+        try:
+            since = datetime.datetime.fromisoformat(since)
+        except ValueError:
+            abort(400)
+    else:
+        since = None
+    # the same for every viewer
+    state = cache_state(None)
+    cached = not_modified(state)
+    if cached is not None:
+        return cached
+    exporter, mimetype = exporters[fmt]
+    jokes = reader().export_jokes(search_words(), since)
+    return conditional(Response(stream_with_context(exporter(jokes)),
+                                content_type=mimetype), state)
+
+
+@app.cli.command('import-jokes')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']),
+              help="Input format, guessed from the file name by default.")
+@click.option('--batch', default=10000, help="Jokes per transaction.")
+def import_jokes(source, fmt, batch):
+    """Import jokes with text, created and author from JSONL or CSV."""
+    if fmt is None:
+        fmt = 'csv' if source.name.endswith('.csv') else 'jsonl'
+    start = time.monotonic()
+    count = 0
+    skipped = 0
+    for count, bad in db().import_jokes(import_rows(source, fmt), batch):
+        for line, reason in bad:
+            click.echo("skipped line %d: %s" % (line, reason), err=True)
+        skipped += len(bad)
+        click.echo("%d jokes, %d/s" %
+                   (count, count / (time.monotonic() - start)))
+    click.echo("imported %d jokes in %.1fs, skipped %d" %
+               (count, time.monotonic() - start, skipped))
+    if skipped:
+        raise SystemExit(1)
+
+
+def import_rows(source, fmt):
+    # (line, joke) of an import file, see DBProxy.import_jokes
+    if fmt == 'csv':
+        jokes = csv.DictReader(source)
+        while True:
+            try:
+                joke = next(jokes)
+            except StopIteration:
+                return
+            except csv.Error as error:
+                joke = ValueError(str(error))
+            yield jokes.line_num, joke
+    else:
+        for line, text in enumerate(source, 1):
+            if text.strip():
+                try:
+                    yield line, json.loads(text)
+                except ValueError as error:
+                    yield line, error
+
+
+@app.cli.command('gc-guests')
+@click.option('--dry-run', is_flag=True, help="Only count the guests.")
+@click.option('--batch', default=10000, help="Guests per transaction.")
+def gc_guests(dry_run, batch):
+    """Delete guests who never voted or submitted a joke."""
+    count = 0
+    for count in db().gc_guests(batch, dry_run):
+        click.echo("%d guests" % count)
+    click.echo("%d guests %s" %
+               (count, "would be deleted" if dry_run else "deleted"))
+
+
+@app.cli.command('verify-tallies')
+def verify_tallies():
+    """Compare the vote tallies against the votes."""
+    drifted = db().verify_tallies()
+    for joke in drifted:
+        click.echo("tally of joke %d drifted" % joke)
+    if drifted:
+        raise SystemExit(1)
+    click.echo("tallies are consistent")
+
+
+@app.cli.command('rebuild-tallies')
+def rebuild_tallies():
+    """Recount the vote tallies from the votes."""
+    db().rebuild_tallies()
+    click.echo("tallies rebuilt")
+
+
+@app.cli.command('refresh-ranks')
+def refresh_ranks():
+    """Decay the ranks, run this from cron at least daily."""
+    db().refresh_ranks()
+    click.echo("ranks refreshed")
+
+
+@app.cli.command('check-queries')
+def check_queries():
+    """Fail if a hot query does a full table scan."""
+    regressed = db().check_query_plans()
+    for sql in regressed:
+        click.echo("full scan: " + sql)
+    if regressed:
+        raise SystemExit(1)
+    click.echo("all hot queries use an index")
 
 
 @app.route('/static/<path:path>')
@@ -687,5 +2426,27 @@ configf.close()
 
 app.debug = config['debug']
 app.secret_key = config['secret_key']
+if config.get('proxies'):
+    # behind reverse proxies the client address is the proxy's,
+    # trust that many X-Forwarded-For entries instead
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=config['proxies'])
+pool = DBPool(config['database'], config['superuser'].lower(),
+              config.get('pool_size', 4), config.get('pool_timeout', 10),
+              config.get('cache_depth', 1000),
+              rank_refresh=config.get('rank_refresh', 3600),
+              journal_mode=config.get('journal_mode', 'wal'),
+              synchronous=config.get('synchronous', 'normal'),
+              busy_timeout=config.get('busy_timeout', 5),
+              slow_query=config.get('slow_query'))
+votes = None
+if config.get('vote_batch'):
+    votes = VoteQueue(pool, config['vote_batch'])
+limiter = None
+if config.get('rate_limit'):
+    limiter = RateLimiter(config['rate_limit'], config.get('rate_burst', 10),
+                          config.get('rate_limit_size', 10000))
+snapshot = None
+if config.get('snapshot_staleness'):
+    snapshot = Snapshot(pool, config['snapshot_staleness'])
 if __name__ == '__main__':
     app.run(host="0.0.0.0")
@@ -0,0 +1,124 @@
+# ASGI entry point: an event loop accepts the connections and the views
+# run on a bounded pool of threads, one per pooled database connection
+#
+#   pip install uvicorn
+#   VOTE_CONFIG=config.json uvicorn asgi:application --host 0.0.0.0
+#
+# a request is handled start to finish by one thread, so the connection
+# it borrows from DBPool never changes threads during a request and slow
+# queries or template rendering do not hold up the event loop
+#
+# rendering holds the GIL, add processes with --workers to use more cores,
+# each process has its own DBPool, JokeCache and Snapshot
+import asyncio
+import concurrent.futures
+import io
+import sys
+from app import app, config
+
+
+class Application(object):
+    def __init__(self, wsgi, threads):
+        self.wsgi = wsgi
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            threads, thread_name_prefix='jokevote')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        body = io.BytesIO()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        body.seek(0)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.run, loop, send,
+                                   self.environ(scope, body))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            # WSGI strings are latin-1 encoded bytes
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope['http_version'],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            # the body is read completely, also when it was sent chunked
+            'wsgi.input_terminated': True,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            if name in environ:
+                value = environ[name] + ',' + value
+            environ[name] = value
+        environ['CONTENT_LENGTH'] = str(len(body.getvalue()))
+        return environ
+
+    def run(self, loop, send, environ):
+        # runs on a worker thread, hands every chunk to the event loop
+        start = {}
+
+        def push(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            # pylint: disable=unused-argument
+            start['message'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'),
+                             value.encode('latin-1'))
+                            for name, value in headers]
+            }
+
+        result = self.wsgi(environ, start_response)
+        try:
+            for chunk in result:
+                if not chunk:
+                    continue
+                if start:
+                    push(start.pop('message'))
+                push({'type': 'http.response.body', 'body': chunk,
+                      'more_body': True})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        if start:
+            push(start.pop('message'))
+        push({'type': 'http.response.body'})
+
+
+application = Application(app, config.get('pool_size', 4))
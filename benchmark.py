@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# times DBProxy methods and routes on synthetic databases of several sizes
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import click
+import generate
+
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'median': statistics.median(times), 'min': min(times),
+            'repeat': repeat}
+
+
+def peak_memory(func):
+    # bytes allocated at most during one run, after the timed runs
+    # warmed up caches
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def cases(app, path):
+    # method cases run on a connection without listing cache,
+    # route cases through the app's pool like a visitor would
+    proxy = app.DBProxy(path, cache=None)
+    # the busiest voter, the top joke and a tag in use
+    voter = proxy.c.execute("SELECT user FROM " + proxy.prefix + "_votes " +
+                            "GROUP BY user ORDER BY COUNT(*) DESC " +
+                            "LIMIT 1").fetchone()
+    voter = voter['user']
+    joke = proxy.c.execute("SELECT joke FROM " + proxy.prefix + "_tallies " +
+                           "WHERE deleted=0 ORDER BY score DESC " +
+                           "LIMIT 1").fetchone()['joke']
+    tag = proxy.c.execute("SELECT text FROM " + proxy.prefix + "_jokes " +
+                          "WHERE text LIKE '%#tag%' LIMIT 1").fetchone()
+    tag = tag['text'][tag['text'].index('#'):]
+    newcomer = proxy.get_user(cookie='benchmark')
+    client = app.app.test_client()
+
+    def vote():
+        proxy.vote_joke(joke, False, newcomer)
+        proxy.unvote_joke(joke, newcomer)
+
+    def route(url):
+        # closing the response returns the connection of a stream
+        with client.get(url) as response:
+            if response.status_code != 200:
+                raise RuntimeError("%s: %d" % (url, response.status_code))
+            return response.data
+
+    methods = {
+        'get_jokes rank': lambda: proxy.get_jokes(voter, limit=10),
+        'get_jokes score': lambda: proxy.get_jokes(voter, sortby='score',
+                                                   limit=10),
+        'get_jokes age': lambda: proxy.get_jokes(voter, sortby='age',
+                                                 limit=10),
+        'get_jokes unread': lambda: proxy.get_jokes(voter, sortby='unread',
+                                                    limit=10),
+        'get_jokes page 50': lambda: proxy.get_jokes(voter, offset=500,
+                                                     limit=10),
+        'get_jokes all': lambda: proxy.get_jokes(voter),
+        'get_jokes tag': lambda: proxy.get_jokes(voter, search=[tag],
+                                                 limit=10),
+        'score': lambda: proxy.score(joke, voter),
+        'scores': proxy.scores,
+        'vote_joke+unvote_joke': vote,
+        'get_user cookie': lambda: proxy.get_user(cookie='guest1'),
+        'get_user name': lambda: proxy.get_user(name='user1'),
+        'get_user password': lambda: proxy.get_user(name='user1',
+                                                    password='password'),
+        'export_jokes': lambda: list(proxy.export_jokes()),
+        'route page': lambda: route('/page/0'),
+        'route page score': lambda: route('/page/3?sort=score'),
+        'route page tag': lambda: route('/page/0?filter=_' + tag[1:]),
+        'route export': lambda: route('/export?format=jsonl')
+    }
+    return methods, proxy
+
+
+def compare(results, baseline, max_slowdown, tolerance):
+    # names of the cases whose median got slower than allowed
+    slower = []
+    for size, timings in results.items():
+        for name, timing in timings.items():
+            before = baseline.get(size, {}).get(name)
+            if before is None:
+                continue
+            if timing['median'] > before['median'] * max_slowdown and \
+                    timing['median'] - before['median'] > tolerance:
+                slower.append("%s jokes, %s: %.2fms -> %.2fms" % (
+                    size, name, before['median'] * 1000,
+                    timing['median'] * 1000))
+    return slower
+
+
+@click.command()
+@click.option('--sizes', default='1000,10000,100000',
+              help="Comma separated numbers of jokes.")
+@click.option('--repeat', default=20, help="Runs per case.")
+@click.option('--output', default='benchmark.json',
+              help="Write the results to this JSON file.")
+@click.option('--baseline', type=click.File('r'),
+              help="Results of an earlier run to compare against.")
+@click.option('--max-slowdown', default=1.5,
+              help="Fail if a case is this many times slower than the "
+                   "baseline.")
+@click.option('--tolerance', default=0.0005,
+              help="Ignore slowdowns of less than this many seconds.")
+@click.option('--workdir', help="Keep the generated databases here.")
+@click.option('--migration-votes', default=1000000,
+              help="Votes of the v0 database to migrate, 0 to skip.")
+@click.option('--migration-budget', default=120.0,
+              help="Fail if the v0 migration takes longer, in seconds.")
+def main(sizes, repeat, output, baseline, max_slowdown, tolerance,
+         workdir, migration_votes, migration_budget):
+    """Benchmark the database methods and routes."""
+    if workdir:
+        os.makedirs(workdir, exist_ok=True)
+    else:
+        workdir = tempfile.mkdtemp()
+    # the app reads its configuration on import
+    config = os.path.join(workdir, 'config.json')
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'config.json.template')) as template:
+        settings = json.load(template)
+    settings['database'] = os.path.join(workdir, 'empty.db')
+    settings['secret_key'] = 'benchmark'
+    settings['superuser'] = 'super0'
+    with open(config, 'w') as configf:
+        json.dump(settings, configf)
+    os.environ['VOTE_CONFIG'] = config
+    import app  # pylint: disable=import-outside-toplevel
+
+    results = {}
+    for size in [int(size) for size in sizes.split(',')]:
+        path = os.path.join(workdir, 'bench%d.db' % size)
+        # per joke: 10 votes, one guest in two, one member in twenty
+        generate.build(path, jokes=size, users=max(size // 20, 2),
+                       guests=max(size // 2, 2), votes=size * 10)
+        timings = results[str(size)] = {}
+        # includes the migration from v1c
+        timings['setup'] = measure(
+            lambda: setattr(app, 'pool',
+                            app.DBPool(path, settings['superuser'])), 1)
+        methods, proxy = cases(app, path)
+        for name, func in methods.items():
+            timings[name] = measure(func, repeat)
+            timings[name]['peak'] = peak_memory(func)
+            click.echo("%d jokes, %s: %.2fms, %dkB peak" %
+                       (size, name, timings[name]['median'] * 1000,
+                        timings[name]['peak'] // 1024))
+        proxy.close()
+
+    over_budget = False
+    if migration_votes:
+        path = os.path.join(workdir, 'v0.db')
+        # half of the votes by address, half only in the counters
+        generate.build_v0(path, jokes=max(migration_votes // 10, 1),
+                          ips=max(migration_votes // 20, 1),
+                          votes=migration_votes // 2,
+                          legacy=migration_votes - migration_votes // 2)
+        timing = measure(lambda: app.DBPool(path, settings['superuser']), 1)
+        results['v0 %d votes' % migration_votes] = {'migration': timing}
+        click.echo("v0 %d votes, migration: %.1fs, budget %.1fs" %
+                   (migration_votes, timing['median'], migration_budget))
+        over_budget = timing['median'] > migration_budget
+
+    with open(output, 'w') as out:
+        json.dump({
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'repeat': repeat,
+            'results': results
+        }, out, indent=2)
+    click.echo("results written to " + output)
+
+    if baseline:
+        slower = compare(results, json.load(baseline)['results'],
+                         max_slowdown, tolerance)
+        for line in slower:
+            click.echo("slower: " + line)
+        if slower:
+            sys.exit(1)
+    if over_budget:
+        click.echo("v0 migration over budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
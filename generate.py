@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# builds a synthetic v1c or v0 database, the app migrates it on the first
+# start
+import datetime
+import hashlib
+import os
+import random
+import sqlite3
+import click
+
+WORDS = ("why did the chicken cross road knock who is there a man walks "
+         "into bar programmer light bulb change it takes two cats dog "
+         "horse doctor says sorry wife husband boss teacher pun").split()
+
+
+def build(path, jokes=10000, users=500, supers=1, guests=5000,
+          votes=100000, down=0.3, skew=1.0, deleted=0.02, tags=0.3,
+          tag_pool=50, days=365, seed=1):
+    # jokes: number of jokes, authored by users and supers
+    # users, supers, guests: number of accounts by role,
+    #   members are called user<n> and super<n> with password "password",
+    #   guests use the cookie guest<n>
+    # votes: number of up- and downvotes, at most one per joke and voter
+    # down: ratio of downvotes
+    # skew: zipf exponent of the popularity of jokes, 0 for uniform
+    # deleted: ratio of jokes deleted by their author
+    # tags: ratio of jokes with a hashtag out of tag_pool tags
+    # days: the jokes were created during the last days
+    if os.path.exists(path):
+        os.remove(path)
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    c.execute("CREATE TABLE v1c_jokes(" +
+              "id INTEGER PRIMARY KEY NOT NULL, " +
+              "text TEXT, format TEXT, user INTEGER, " +
+              "created TIMESTAMP)")
+    c.execute("CREATE TABLE v1c_votes(" +
+              "id INTEGER PRIMARY KEY NOT NULL, " +
+              "joke INTEGER, user INTEGER, type TEXT)")
+    c.execute("CREATE TABLE v1c_users(" +
+              "id INTEGER PRIMARY KEY NOT NULL, " +
+              "identifier TEXT, role TEXT DEFAULT 'guest', " +
+              "password TEXT DEFAULT '', salt TEXT DEFAULT '')")
+
+    salt = b'0' * 64
+    password = hashlib.sha512(b'password' + salt).hexdigest()
+    accounts = [('super%d' % n, 'super', password, salt)
+                for n in range(supers)]
+    accounts += [('user%d' % n, 'user', password, salt)
+                 for n in range(users)]
+    accounts += [('guest%d' % n, 'guest', '', '') for n in range(guests)]
+    c.executemany("INSERT INTO v1c_users(id, identifier, role, " +
+                  "password, salt) VALUES(?, ?, ?, ?, ?)",
+                  [(uid,) + account
+                   for uid, account in enumerate(accounts, 1)])
+    authors = supers + users
+    voters = len(accounts)
+
+    now = datetime.datetime.now()
+    rows = []
+    for joke in range(1, jokes + 1):
+        text = " ".join(rnd.choice(WORDS)
+                        for _ in range(rnd.randint(5, 30)))
+        if rnd.random() < tags:
+            # popular tags are used more often
+            tag = int(rnd.paretovariate(1)) % tag_pool
+            text += " #tag%d" % tag
+        rows.append((joke, text, 'prettytext', rnd.randint(1, authors),
+                     now - datetime.timedelta(seconds=rnd.random() *
+                                              days * 86400)))
+    c.executemany("INSERT INTO v1c_jokes(id, text, format, user, created) " +
+                  "VALUES(?, ?, ?, ?, ?)", rows)
+    authored = [(row[0], row[3]) for row in rows]
+
+    # the n-th joke is picked with a weight of 1/n^skew
+    weights = [1 / pow(n, skew) for n in range(1, jokes + 1)]
+    popular = list(range(1, jokes + 1))
+    rnd.shuffle(popular)
+    voted = set()
+    rows = []
+    votes = min(votes, jokes * voters)
+    while len(rows) < votes:
+        for joke in rnd.choices(popular, weights, k=votes - len(rows)):
+            voter = rnd.randint(1, voters)
+            if (joke, voter) in voted:
+                continue
+            voted.add((joke, voter))
+            rows.append((joke, voter,
+                         'down' if rnd.random() < down else 'up'))
+    c.executemany("INSERT INTO v1c_votes(joke, user, type) " +
+                  "VALUES(?, ?, ?)", rows)
+    # deletion marks are set by the author
+    c.executemany("INSERT INTO v1c_votes(joke, user, type) " +
+                  "VALUES(?, ?, 'delete')",
+                  [(joke, author) for joke, author in authored
+                   if rnd.random() < deleted])
+    conn.commit()
+    conn.close()
+
+
+def build_v0(path, jokes=10000, ips=5000, votes=100000, legacy=100000,
+             down=0.3, seed=1):
+    # jokes: number of jokes
+    # ips: number of distinct voter addresses
+    # votes: number of up- and downvotes by address,
+    #   an address may vote for a joke more than once
+    # legacy: number of pre-v0 votes, only counted in upvotes and downvotes
+    # down: ratio of downvotes
+    if os.path.exists(path):
+        os.remove(path)
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    c.execute("CREATE TABLE jokes(" +
+              "id INTEGER PRIMARY KEY NOT NULL, " +
+              "text TEXT, upvotes INTEGER, " +
+              "downvotes INTEGER, reports INTEGER)")
+    c.execute("CREATE TABLE votes(" +
+              "id INTEGER PRIMARY KEY NOT NULL, " +
+              "ip TEXT, jokeid INTEGER, type INTEGER)")
+
+    counters = [[0, 0] for _ in range(jokes + 1)]
+    rows = []
+    for _ in range(votes):
+        joke = rnd.randint(1, jokes)
+        vote = 1 if rnd.random() < down else 0
+        counters[joke][vote] += 1
+        ip = rnd.randint(1, ips)
+        rows.append(('10.%d.%d.%d' % (ip >> 16 & 255, ip >> 8 & 255,
+                                      ip & 255), joke, -1 if vote else 1))
+    c.executemany("INSERT INTO votes(ip, jokeid, type) VALUES(?, ?, ?)",
+                  rows)
+    for _ in range(legacy):
+        counters[rnd.randint(1, jokes)][1 if rnd.random() < down else 0] += 1
+    c.executemany("INSERT INTO jokes(id, text, upvotes, downvotes, " +
+                  "reports) VALUES(?, ?, ?, ?, 0)",
+                  [(joke, " ".join(rnd.choice(WORDS)
+                                   for _ in range(rnd.randint(5, 30))),
+                    counters[joke][0], counters[joke][1])
+                   for joke in range(1, jokes + 1)])
+    conn.commit()
+    conn.close()
+
+
+@click.command()
+@click.argument('path')
+@click.option('--jokes', default=10000)
+@click.option('--users', default=500, help="Registered users.")
+@click.option('--supers', default=1, help="Superusers.")
+@click.option('--guests', default=5000)
+@click.option('--votes', default=100000, help="Up- and downvotes.")
+@click.option('--down', default=0.3, help="Ratio of downvotes.")
+@click.option('--skew', default=1.0,
+              help="Zipf exponent of the joke popularity, 0 for uniform.")
+@click.option('--deleted', default=0.02, help="Ratio of deleted jokes.")
+@click.option('--tags', default=0.3, help="Ratio of jokes with a hashtag.")
+@click.option('--tag-pool', default=50, help="Number of distinct tags.")
+@click.option('--days', default=365, help="Age of the oldest joke.")
+@click.option('--seed', default=1)
+@click.option('--v0', is_flag=True,
+              help="Build a v0 database, guests are voter addresses.")
+@click.option('--legacy', default=100000,
+              help="Pre-v0 votes of a v0 database, only counted.")
+def main(path, v0, legacy, **options):
+    """Build a synthetic v1c or v0 database at PATH."""
+    if v0:
+        build_v0(path, jokes=options['jokes'], ips=options['guests'],
+                 votes=options['votes'], legacy=legacy,
+                 down=options['down'], seed=options['seed'])
+    else:
+        build(path, **options)
+    click.echo("built " + path)
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
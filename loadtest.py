@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# measures the throughput of a running server under concurrent visitors,
+# e.g. to compare `python app.py` against `uvicorn asgi:application`
+import http.client
+import statistics
+import threading
+import time
+import urllib.parse
+import click
+
+
+def visitor(url, deadline, latencies, errors):
+    # one keep-alive connection and session per visitor
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+    headers = {}
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            errors.append(1)
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname,
+                                              parts.port or 80)
+            continue
+        if response.status != 200:
+            errors.append(response.status)
+            continue
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            headers['Cookie'] = cookie.split(';', 1)[0]
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+
+
+@click.command()
+@click.argument('url')
+@click.option('--concurrency', default=16, help="Parallel visitors.")
+@click.option('--duration', default=10.0, help="Seconds to run.")
+def main(url, concurrency, duration):
+    """Request URL from concurrent visitors and report the throughput."""
+    latencies = []
+    errors = []
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=visitor,
+                                args=(url, deadline, latencies, errors))
+               for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if not latencies:
+        raise SystemExit("no successful requests, %d errors" % len(errors))
+    latencies.sort()
+    click.echo("%d requests, %d errors, %.1f requests/s, "
+               "median %.1fms, p95 %.1fms" % (
+                   len(latencies), len(errors), len(latencies) / duration,
+                   statistics.median(latencies) * 1000,
+                   latencies[int(len(latencies) * 0.95)] * 1000))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter